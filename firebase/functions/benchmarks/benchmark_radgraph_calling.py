@@ -0,0 +1,190 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Measures the overhead of a call to the RadGraph function when fetching an ID token and
+# opening a new TLS connection for every report, as done before, and with the pooled
+# session and cached ID token of radgraph_calling. A local HTTPS server with a
+# self-signed certificate stands in for the function and for the metadata server that
+# issues the ID tokens, hence the measured overhead excludes any network latency.
+# Requires the openssl command line tool.
+#
+# Usage (from the firebase/functions directory):
+#   python -m benchmarks.benchmark_radgraph_calling [--calls 200]
+
+import argparse
+import base64
+import json
+import os
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+
+from function_implementation.radgraph import radgraph_calling
+
+RESPONSE = json.dumps(
+    {"radgraph_text": "", "processed_annotations": [], "radgraph_annotations": {}}
+).encode()
+
+
+def make_id_token(expiry):
+    header, payload = (
+        base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+        for part in ({"alg": "RS256"}, {"exp": expiry})
+    )
+    return f"{header}.{payload}.c2lnbmF0dXJl"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, which otherwise waits for the
+    # delayed acknowledgement of the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # ID token of the metadata server
+    def do_GET(self):
+        self._respond(make_id_token(int(time.time()) + 3600).encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._respond(RESPONSE)
+
+
+def start_stand_in_server(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        capture_output=True,
+        check=True,
+    )
+    server = ThreadingHTTPServer(("localhost", 0), StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, certfile
+
+
+# Fetches the token from the stand-in with the transport passed by the caller, like the
+# metadata server is queried by fetch_id_token
+def fetch_id_token_from_stand_in(url):
+    def fetch_id_token(request, audience):
+        return request(url=f"{url}/token", method="GET").data.decode()
+
+    return fetch_id_token
+
+
+# The calls as done before the pooled session and the cached ID token
+def call_without_pooling(url, report):
+    token = id_token.fetch_id_token(Request(), url)
+    response = requests.post(
+        url,
+        headers={"Authorization": f"Bearer {token}"},
+        json={"report": report},
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def measure_calls(call, calls):
+    durations = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        server, certfile = start_stand_in_server(directory)
+        url = f"https://localhost:{server.server_address[1]}"
+        os.environ.pop("RADGRAPH_EMULATED", None)
+        # Trusts the self-signed certificate in all sessions, including the ones of
+        # the per-call Request objects
+        os.environ["REQUESTS_CA_BUNDLE"] = certfile
+
+        with (
+            mock.patch.object(
+                id_token, "fetch_id_token", fetch_id_token_from_stand_in(url)
+            ),
+            mock.patch.object(radgraph_calling, "RADGRAPH_FUNCTION_URL", url),
+        ):
+            results = [
+                (
+                    "new connection and token",
+                    measure_calls(
+                        lambda: call_without_pooling(url, "Lungs clear."), args.calls
+                    ),
+                ),
+                (
+                    "pooled and cached",
+                    measure_calls(
+                        lambda: radgraph_calling.get_processed_annotation_from_radgraph(
+                            "Lungs clear."
+                        ),
+                        args.calls,
+                    ),
+                ),
+            ]
+        server.shutdown()
+
+    medians = []
+    for name, durations in results:
+        medians.append(statistics.median(durations))
+        print(
+            f"{name:>24}: median {medians[-1] * 1000:7.2f}ms, "
+            f"p95 {statistics.quantiles(durations, n=20)[-1] * 1000:7.2f}ms per call"
+        )
+    print(
+        f"{'overhead removed':>24}: {(medians[0] - medians[1]) * 1000:7.2f}ms per call"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Measures mapping the relevant tokens of long synthetic reports with few findings to the
+# user-provided text, once by aligning all tokens with the text, as done before, and once
+# by looking up only the relevant tokens by their cumulative offsets.
+#
+# Usage (from the firebase/functions directory):
+#   python -m benchmarks.benchmark_relevant_token_mapping [--sentences 50 200 800]
+#     [--findings 5] [--runs 20]
+
+import argparse
+import statistics
+import time
+
+from function_implementation.text_mapping import radgraph_text_mapper
+
+SENTENCE = "No focal consolidation, pleural effusion or pneumothorax is seen.\n"
+SENTENCE_TOKENS = (
+    "No focal consolidation , pleural effusion or pneumothorax is seen .".split(" ")
+)
+
+
+def make_report(sentence_count, finding_count):
+    total_tokens = SENTENCE_TOKENS * sentence_count
+    step = max(1, len(total_tokens) // finding_count)
+    relevant_entities = [
+        (token_index, token_index + 1)
+        for token_index in range(0, len(total_tokens) - 1, step)
+    ][:finding_count]
+    return total_tokens, SENTENCE * sentence_count, relevant_entities
+
+
+def measure(mapping, total_tokens, user_provided_text, relevant_entities, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        mapping(total_tokens, user_provided_text, relevant_entities)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sentences", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--findings", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    align_all = (
+        radgraph_text_mapper.__map_radgraph_relevant_token_entities_to_text_ranges
+    )
+    look_up_relevant = radgraph_text_mapper.__map_radgraph_relevant_token_entities_by_cumulative_offsets
+    for sentence_count in args.sentences:
+        report = make_report(sentence_count, args.findings)
+        assert align_all(*report) == look_up_relevant(*report)
+
+        aligned = measure(align_all, *report, args.runs)
+        looked_up = measure(look_up_relevant, *report, args.runs)
+        print(
+            f"{len(report[0]):>6} tokens, {len(report[2])} findings: "
+            f"aligning all {aligned * 1000:7.3f}ms, "
+            f"relevant only {looked_up * 1000:7.3f}ms, {aligned / looked_up:5.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Measures restoring the located_at_end_ix of the processed annotations of synthetic
+# reports with hundreds of entities, once by scanning all entities for every start index,
+# as done before, and once with the start_ix to end_ix index of radgraph_text_mapper that
+# is built once per RadGraph output.
+#
+# Usage (from the firebase/functions directory):
+#   python -m benchmarks.benchmark_text_mapping [--entities 100 300 1000] [--runs 20]
+
+import argparse
+import copy
+import statistics
+import time
+
+from function_implementation.text_mapping import radgraph_text_mapper
+
+# Every observation is located at this many anatomies
+LOCATED_AT_PER_OBSERVATION = 2
+
+
+# Every other entity is an observation located at the following anatomies, spanning two
+# tokens each
+def make_radgraph_output(entity_count):
+    entities = {
+        str(i): {"start_ix": 2 * i, "end_ix": 2 * i + 1} for i in range(entity_count)
+    }
+    processed_annotations = [
+        {
+            "observation_start_ix": [2 * i],
+            "observation_end_ix": [2 * i + 1],
+            "located_at_start_ix": [
+                [
+                    2 * ((i + offset) % entity_count)
+                    for offset in range(1, LOCATED_AT_PER_OBSERVATION + 1)
+                ]
+            ],
+        }
+        for i in range(0, entity_count, 2)
+    ]
+    return {
+        "radgraph_annotations": {"0": {"entities": entities}},
+        "processed_annotations": processed_annotations,
+    }
+
+
+def add_end_ix_by_scanning_entities(radgraph_output):
+    entities = radgraph_output["radgraph_annotations"]["0"]["entities"]
+    for processed_annotation in radgraph_output["processed_annotations"]:
+        processed_annotation["located_at_end_ix"] = [
+            [
+                next(
+                    entities[entity]["end_ix"]
+                    for entity in entities
+                    if entities[entity]["start_ix"] == start_idx
+                )
+                for start_idx in located_at_start_observation
+            ]
+            for located_at_start_observation in processed_annotation[
+                "located_at_start_ix"
+            ]
+        ]
+    return radgraph_output["processed_annotations"]
+
+
+def add_end_ix_with_index(radgraph_output):
+    return radgraph_text_mapper.add_end_ix_to_processed_annotations(
+        radgraph_output["processed_annotations"],
+        radgraph_output,
+        radgraph_text_mapper.get_end_ix_by_start_ix(radgraph_output),
+    )
+
+
+def measure(add_end_ix, radgraph_output, runs):
+    durations = []
+    for _ in range(runs):
+        # Both variants fill in the processed annotations in place
+        radgraph_output_copy = copy.deepcopy(radgraph_output)
+        start = time.perf_counter()
+        add_end_ix(radgraph_output_copy)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    for entity_count in args.entities:
+        radgraph_output = make_radgraph_output(entity_count)
+        assert add_end_ix_by_scanning_entities(
+            copy.deepcopy(radgraph_output)
+        ) == add_end_ix_with_index(copy.deepcopy(radgraph_output))
+
+        scanning = measure(add_end_ix_by_scanning_entities, radgraph_output, args.runs)
+        index = measure(add_end_ix_with_index, radgraph_output, args.runs)
+        print(
+            f"{entity_count:>5} entities: scanning {scanning * 1000:8.3f}ms, "
+            f"index {index * 1000:8.3f}ms, {scanning / index:6.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Measures aligning the RadGraph tokens with adversarial report texts of growing length,
+# once by comparing every token at every following character, as done before, and once
+# with the alignment of radgraph_text_mapper. The time per character of the latter stays
+# constant as the texts grow, whereas it grows with the text for the former:
+#   long token: a token of half the length of the text that only misses its last
+#     character, which is compared at every character of the text
+#   rewritten tokens: a report in which the RadGraph tokenizer rewrote the quotes, the
+#     former alignment searches the first quote until the end of the text and loses all
+#     following tokens
+#
+# Usage (from the firebase/functions directory):
+#   python -m benchmarks.benchmark_token_alignment [--lengths 1000 2000 4000]
+
+import argparse
+import time
+
+from function_implementation.text_mapping import radgraph_text_mapper
+
+REWRITTEN_SENTENCE = "Liver “mild” lesion, kidneys “normal”.\n"
+REWRITTEN_TOKENS = 'Liver " mild " lesion , kidneys " normal " .'.split(" ")
+
+
+def align_by_comparing_at_every_character(total_tokens, user_provided_text):
+    total_entities_to_text_ranges_dict = {}
+
+    text_pointer = 0
+    for token_index, token in enumerate(total_tokens):
+        while text_pointer < len(user_provided_text):
+            next_text_pointer = 0
+
+            while (
+                next_text_pointer < len(token)
+                and next_text_pointer + text_pointer < len(user_provided_text)
+                and token[next_text_pointer]
+                == user_provided_text[text_pointer + next_text_pointer]
+            ):
+                next_text_pointer += 1
+
+            if next_text_pointer >= len(token):
+                total_entities_to_text_ranges_dict[token_index] = (
+                    text_pointer,
+                    text_pointer + next_text_pointer,
+                )
+
+                text_pointer += next_text_pointer
+                break
+            text_pointer += 1
+    return total_entities_to_text_ranges_dict
+
+
+def align(total_tokens, user_provided_text):
+    return radgraph_text_mapper.__map_all_token_entities_to_text_ranges(
+        total_tokens, user_provided_text
+    )
+
+
+def make_long_token_input(length):
+    return ["a" * (length // 2) + "b"], "a" * length
+
+
+def make_rewritten_tokens_input(length):
+    repetitions = max(1, length // len(REWRITTEN_SENTENCE))
+    return REWRITTEN_TOKENS * repetitions, REWRITTEN_SENTENCE * repetitions
+
+
+def measure(alignment, total_tokens, user_provided_text):
+    start = time.perf_counter()
+    ranges = alignment(total_tokens, user_provided_text)
+    return time.perf_counter() - start, len(ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1000, 2000, 4000])
+    args = parser.parse_args()
+
+    for name, make_input in (
+        ("long token", make_long_token_input),
+        ("rewritten tokens", make_rewritten_tokens_input),
+    ):
+        print(name)
+        for length in args.lengths:
+            total_tokens, user_provided_text = make_input(length)
+            for alignment_name, alignment in (
+                ("every character", align_by_comparing_at_every_character),
+                ("bounded", align),
+            ):
+                duration, aligned_tokens = measure(
+                    alignment, total_tokens, user_provided_text
+                )
+                print(
+                    f"  {len(user_provided_text):>6} characters, {alignment_name:>15}: "
+                    f"{duration * 1e9 / len(user_provided_text):9.1f}ns per character, "
+                    f"{aligned_tokens}/{len(total_tokens)} tokens aligned"
+                )
+
+
+if __name__ == "__main__":
+    main()
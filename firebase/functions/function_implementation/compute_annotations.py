@@ -7,12 +7,14 @@
 #
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from enum import Enum
-import functools
 import json
 import pathlib
 import re
+import threading
+import time
 
 from firebase_admin import storage, firestore
 from firebase_functions import https_fn, storage_fn
@@ -24,15 +26,26 @@ from function_implementation.on_report_meta_data_delete import (
 from function_implementation.consent_check import has_consent
 from function_implementation.llm_calling.chatgpt import request_report_validation
 from function_implementation.radgraph.radgraph_calling import (
-    get_processed_annotation_from_radgraph,
+    RadGraphDeadlineExceededError,
+    RadGraphOverloadedError,
+    get_processed_annotation_from_radgraph_async,
 )
 from function_implementation.text_mapping.radgraph_text_mapper import (
     add_end_ix_to_processed_annotations,
+    get_end_ix_by_start_ix,
     get_entity_mapping_in_user_entered_text,
 )
 
 MAX_REPORTS_UPLOAD = 5
 COMPUTE_ANNOTATIONS_TIMEOUT_SEC = 70
+# Threads running the blocking Cloud Storage, Firestore and OpenAI calls of all reports
+# computed concurrently
+COMPUTE_ANNOTATIONS_WORKERS = 32
+
+# The annotations of all reports are computed on one long-lived event loop, so that the
+# connections of the async RadGraph client are reused across reports
+__event_loop = None
+__event_loop_lock = threading.Lock()
 
 
 class ErrorCode(Enum):
@@ -58,14 +71,24 @@ def __get_report_meta_data_ref(
     return ref
 
 
-def __get_postprocessed_annotations(user_provided_report: str):
-    processed_annotations = get_processed_annotation_from_radgraph(user_provided_report)
+async def __get_postprocessed_annotations(user_provided_report: str, deadline: float):
+    processed_annotations = await get_processed_annotation_from_radgraph_async(
+        user_provided_report, deadline
+    )
+    # The RadGraph function already sends located_at_end_ix if it adds token offsets
+    end_ix_by_start_ix = None
+    if any(
+        "located_at_end_ix" not in processed_annotation
+        for processed_annotation in processed_annotations["processed_annotations"]
+    ):
+        end_ix_by_start_ix = get_end_ix_by_start_ix(processed_annotations)
     text_mapping = get_entity_mapping_in_user_entered_text(
-        user_provided_report, processed_annotations
+        user_provided_report, processed_annotations, end_ix_by_start_ix
     )
     processed_annotations = add_end_ix_to_processed_annotations(
         processed_annotations["processed_annotations"],
         processed_annotations,
+        end_ix_by_start_ix,
     )
     return processed_annotations, text_mapping
 
@@ -99,26 +122,44 @@ def __is_upload_limiter_valid(uid: int, file_name: str) -> bool:
     return update_user_uploaded_documents(transaction)
 
 
-def __compute_annotations(
+async def __compute_annotations(
     user_provided_report: str,
     uid: str,
     file_name: str,
     report_meta_data_ref: DocumentReference,
+    deadline: float,
 ):
-    if __is_upload_limiter_valid(uid, file_name) is False:
-        report_meta_data_ref.update(
-            {"error_code": ErrorCode.UPLOAD_LIMIT_REACHED.value}
+    loop = asyncio.get_running_loop()
+    if (
+        await loop.run_in_executor(None, __is_upload_limiter_valid, uid, file_name)
+        is False
+    ):
+        await loop.run_in_executor(
+            None,
+            report_meta_data_ref.update,
+            {"error_code": ErrorCode.UPLOAD_LIMIT_REACHED.value},
         )
         return
 
-    if request_report_validation(user_provided_report) is False:
-        report_meta_data_ref.update({"error_code": ErrorCode.VALIDATION_FAILED.value})
+    if (
+        await loop.run_in_executor(
+            None, request_report_validation, user_provided_report
+        )
+        is False
+    ):
+        await loop.run_in_executor(
+            None,
+            report_meta_data_ref.update,
+            {"error_code": ErrorCode.VALIDATION_FAILED.value},
+        )
         return
 
-    processed_annotations, text_mapping = __get_postprocessed_annotations(
-        user_provided_report
+    processed_annotations, text_mapping = await __get_postprocessed_annotations(
+        user_provided_report, deadline
     )
-    report_meta_data_ref.update(
+    await loop.run_in_executor(
+        None,
+        report_meta_data_ref.update,
         {
             "processed_annotations": json.dumps(processed_annotations),
             "text_mapping": json.loads(json.dumps(text_mapping)),
@@ -134,36 +175,66 @@ async def __compute_annotations_timeout(
     timeout: int,
     report_meta_data_ref: DocumentReference,
 ):
+    loop = asyncio.get_running_loop()
     try:
-        user_provided_report = __get_report_from_cloud_storage(bucket, file_path)
+        user_provided_report = await loop.run_in_executor(
+            None, __get_report_from_cloud_storage, bucket, file_path
+        )
 
-        report_meta_data_ref.set(
+        await loop.run_in_executor(
+            None,
+            report_meta_data_ref.set,
             {
                 "user_provided_text": user_provided_report,
                 "create_time": firestore.SERVER_TIMESTAMP,
-            }
+            },
         )
 
-        loop = asyncio.get_running_loop()
+        # Passed on to the RadGraph function, so that its inference stops once the
+        # result is no longer awaited. The timeout cancels the request itself.
+        deadline = time.time() + timeout
+
         await asyncio.wait_for(
-            loop.run_in_executor(
-                None,
-                functools.partial(
-                    __compute_annotations,
-                    user_provided_report,
-                    uid,
-                    file_name,
-                    report_meta_data_ref,
-                ),
+            __compute_annotations(
+                user_provided_report,
+                uid,
+                file_name,
+                report_meta_data_ref,
+                deadline,
             ),
             timeout=timeout,
         )
+    # An overloaded RadGraph function would not have annotated the report in time
+    # either, hence both are reported as timeout that can be retriggered by the user
     except Exception as e:
-        report_meta_data_ref.update({"error_code": ErrorCode.TIMEOUT.value})
-        if not isinstance(e, asyncio.TimeoutError):
+        await loop.run_in_executor(
+            None, report_meta_data_ref.update, {"error_code": ErrorCode.TIMEOUT.value}
+        )
+        if not isinstance(
+            e,
+            (
+                asyncio.TimeoutError,
+                RadGraphDeadlineExceededError,
+                RadGraphOverloadedError,
+            ),
+        ):
             raise
 
 
+def __run_on_event_loop(coroutine):
+    global __event_loop
+    with __event_loop_lock:
+        if __event_loop is None:
+            __event_loop = asyncio.new_event_loop()
+            __event_loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=COMPUTE_ANNOTATIONS_WORKERS)
+            )
+            threading.Thread(
+                target=__event_loop.run_forever, name="compute-annotations", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, __event_loop).result()
+
+
 def on_medical_report_upload_impl(
     event: storage_fn.CloudEvent[storage_fn.StorageObjectData],
 ):
@@ -182,7 +253,7 @@ def on_medical_report_upload_impl(
         remove_data_associated_to_file(uid, file_name)
         return
 
-    asyncio.run(
+    __run_on_event_loop(
         __compute_annotations_timeout(
             event.data.bucket,
             file_path,
@@ -233,7 +304,7 @@ def on_annotate_file_retrigger_impl(req: https_fn.Request) -> https_fn.Response:
 
     file_path = f"users/{uid}/reports/{file_name}"
 
-    asyncio.run(
+    __run_on_event_loop(
         __compute_annotations_timeout(
             storage.bucket().name,
             file_path,
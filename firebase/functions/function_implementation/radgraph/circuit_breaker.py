@@ -0,0 +1,147 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import collections
+import contextlib
+from enum import Enum
+import json
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# The breaker opens once at least FAILURE_RATIO of the last WINDOW_CALLS calls failed,
+# after at least MIN_CALLS calls. Calls slower than SLOW_CALL_SEC count as failed, as a
+# degraded backend often still answers, only too late.
+WINDOW_CALLS = 20
+MIN_CALLS = 5
+FAILURE_RATIO = 0.5
+SLOW_CALL_SEC = 30
+# An open breaker rejects all calls for OPEN_SEC, then lets a single probe call through,
+# which closes the breaker if it succeeds and opens it again otherwise
+OPEN_SEC = 30
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        is_failure: Callable[[Exception, bool], bool],
+        open_sec: float = OPEN_SEC,
+        slow_call_sec: float = SLOW_CALL_SEC,
+    ):
+        self.name = name
+        self.is_failure = is_failure
+        self.open_sec = open_sec
+        self.slow_call_sec = slow_call_sec
+        self.state = CircuitState.CLOSED
+        self.transitions = collections.Counter()
+        self._lock = threading.Lock()
+        self._failures = collections.deque(maxlen=WINDOW_CALLS)
+        self._opened_at = 0.0
+        self._is_probe_running = False
+
+    # Returns None if the call is rejected, otherwise whether the call is the probe of a
+    # half-open breaker, which is passed on to observe_call
+    def allow_call(self) -> Optional[bool]:
+        with self._lock:
+            if (
+                self.state == CircuitState.OPEN
+                and time.monotonic() - self._opened_at >= self.open_sec
+            ):
+                self._transition(CircuitState.HALF_OPEN)
+            if self.state == CircuitState.CLOSED:
+                return False
+            if self.state == CircuitState.HALF_OPEN and not self._is_probe_running:
+                self._is_probe_running = True
+                return True
+            return None
+
+    def retry_after_sec(self) -> float:
+        with self._lock:
+            if self.state != CircuitState.OPEN:
+                return 0.0
+            return max(self.open_sec - (time.monotonic() - self._opened_at), 0.0)
+
+    # Records the outcome of the call run within the context. Calls that are cancelled
+    # or fail for reasons other than the backend neither count as success nor failure.
+    # is_failure is passed the error and whether the call ran at least slow_call_sec.
+    @contextlib.contextmanager
+    def observe_call(self, is_probe: bool):
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as error:
+            is_slow = time.monotonic() - start >= self.slow_call_sec
+            self._finish_call(
+                is_probe, True if self.is_failure(error, is_slow) else None
+            )
+            raise
+        except BaseException:
+            self._finish_call(is_probe, None)
+            raise
+        self._finish_call(is_probe, time.monotonic() - start >= self.slow_call_sec)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "state": self.state.value,
+                "recent_calls": len(self._failures),
+                "recent_failures": sum(self._failures),
+                "transitions": {
+                    state.value: count for state, count in self.transitions.items()
+                },
+            }
+
+    def _finish_call(self, is_probe: bool, failed: Optional[bool]) -> None:
+        with self._lock:
+            if is_probe:
+                self._is_probe_running = False
+                if failed is not None:
+                    self._transition(
+                        CircuitState.OPEN if failed else CircuitState.CLOSED
+                    )
+                return
+            # Calls that were started before the breaker opened are not counted
+            if failed is None or self.state != CircuitState.CLOSED:
+                return
+            self._failures.append(failed)
+            if len(self._failures) >= MIN_CALLS and sum(
+                self._failures
+            ) >= FAILURE_RATIO * len(self._failures):
+                self._transition(CircuitState.OPEN)
+
+    # Logged as structured log entry with the recent calls and failures that led to it,
+    # which log-based metrics can count by state
+    def _transition(self, state: CircuitState) -> None:
+        recent_calls = len(self._failures)
+        recent_failures = sum(self._failures)
+        if state == CircuitState.OPEN:
+            self._opened_at = time.monotonic()
+        if state == CircuitState.CLOSED:
+            self._failures.clear()
+        self.state = state
+        self.transitions[state] += 1
+        print(
+            json.dumps(
+                {
+                    "severity": "INFO" if state == CircuitState.CLOSED else "WARNING",
+                    "message": f"RadGraph circuit breaker of {self.name} is {state.value}",
+                    "radgraph_backend": self.name,
+                    "circuit_state": state.value,
+                    "recent_calls": recent_calls,
+                    "recent_failures": recent_failures,
+                }
+            ),
+            flush=True,
+        )
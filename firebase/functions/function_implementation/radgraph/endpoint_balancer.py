@@ -0,0 +1,91 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import contextlib
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Weight of the latest latency in the moving average of an endpoint
+LATENCY_SMOOTHING = 0.3
+# Latency observed for a failed call, so that an endpoint that fails fast does not
+# attract the calls
+FAILURE_PENALTY_SEC = 10.0
+
+
+class EndpointBalancer:
+    def __init__(self, urls: List[str]):
+        self.urls = list(urls)
+        self._lock = threading.Lock()
+        self._latency_sec: Dict[str, Optional[float]] = {url: None for url in urls}
+        self._in_flight = {url: 0 for url in urls}
+
+    # Expected time until a new call completes. Endpoints without observed latency come
+    # first, so that every endpoint is tried.
+    def _cost(self, url: str) -> float:
+        latency_sec = self._latency_sec[url]
+        if latency_sec is None:
+            return 0.0
+        return latency_sec * (self._in_flight[url] + 1)
+
+    # Returns the urls in the order they should be tried: the cheaper of two randomly
+    # chosen endpoints, the other one, then the rest by cost. Comparing only two random
+    # endpoints instead of taking the cheapest of all keeps concurrent callers from all
+    # piling onto the same endpoint between two latency updates.
+    def order(self) -> List[str]:
+        with self._lock:
+            if len(self.urls) == 1:
+                return list(self.urls)
+            candidates = sorted(random.sample(self.urls, 2), key=self._cost)
+            others = sorted(
+                (url for url in self.urls if url not in candidates), key=self._cost
+            )
+            return candidates + others
+
+    @contextlib.contextmanager
+    def track_call(self, url: str):
+        if url not in self._in_flight:
+            yield
+            return
+
+        with self._lock:
+            self._in_flight[url] += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self._finish_call(url, FAILURE_PENALTY_SEC)
+            raise
+        # Cancelled calls took at least as long as they ran
+        except BaseException:
+            elapsed_sec = time.monotonic() - start
+            self._finish_call(url, max(elapsed_sec, self._latency_sec[url] or 0.0))
+            raise
+        self._finish_call(url, time.monotonic() - start)
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        with self._lock:
+            return {
+                url: {
+                    "latency_sec": self._latency_sec[url],
+                    "in_flight": self._in_flight[url],
+                }
+                for url in self.urls
+            }
+
+    def _finish_call(self, url: str, latency_sec: float) -> None:
+        with self._lock:
+            self._in_flight[url] -= 1
+            previous_latency_sec = self._latency_sec[url]
+            if previous_latency_sec is None:
+                self._latency_sec[url] = latency_sec
+            else:
+                self._latency_sec[url] = previous_latency_sec + LATENCY_SMOOTHING * (
+                    latency_sec - previous_latency_sec
+                )
@@ -6,24 +6,552 @@
 # SPDX-License-Identifier: MIT
 #
 
+import asyncio
+import collections
+import contextlib
+import json
 import os
+import threading
+import time
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import httpx
 import requests
+from google.auth import jwt
 from google.oauth2 import id_token
 from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+
+from function_implementation.radgraph.circuit_breaker import CircuitBreaker
+from function_implementation.radgraph.endpoint_balancer import EndpointBalancer
+from function_implementation.radgraph.radgraph_in_process import (
+    annotate_reports_in_process,
+)
 
+# Set RADGRAPH_BACKEND to this to annotate the reports with RadGraph loaded into this
+# process instead of calling the deployed RadGraph function, or the emulated one if
+# RADGRAPH_EMULATED is set. This saves the serialization and network latency for
+# self-hosted and batch deployments, but requires the radgraph package.
+IN_PROCESS_BACKEND = "in_process"
 EMULATED_FUNCTION_URL = "http://localhost:5002"
 RADGRAPH_FUNCTION_URL = (
     "https://us-central1-gcp-mcqa-eval.cloudfunctions.net/radgraph-http-function"
 )
 
 
-def get_processed_annotation_from_radgraph(user_report: str):
-    payload = {"report": user_report}
-    if os.environ.get("RADGRAPH_EMULATED"):
-        response = requests.post(EMULATED_FUNCTION_URL, json=payload)
-    else:
-        token = id_token.fetch_id_token(Request(), RADGRAPH_FUNCTION_URL)
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.post(RADGRAPH_FUNCTION_URL, headers=headers, json=payload)
+# Comma-separated URLs of equivalent RadGraph deployments, e.g. in several regions or
+# self-hosted replicas. Every call goes to the endpoint with the lower expected latency
+# of two random endpoints, see EndpointBalancer. Whitespace around the URLs and empty
+# entries, e.g. of a trailing comma, are ignored.
+def __parse_function_urls(function_urls: str) -> List[str]:
+    return [url.strip() for url in function_urls.split(",") if url.strip()]
+
+
+RADGRAPH_FUNCTION_URLS = __parse_function_urls(
+    os.environ.get("RADGRAPH_FUNCTION_URLS", RADGRAPH_FUNCTION_URL)
+)
+
+# Seconds until the deadline of the caller, the function rejects reports it cannot
+# annotate within that time and stops working on them once the time has passed. The
+# remaining time is sent instead of the absolute deadline, as the clocks of the caller
+# and the function are not synchronized.
+DEADLINE_HEADER = "X-Request-Deadline-Sec"
+# 429: the report cannot be annotated before the deadline
+# 503: the queue of the function is full
+OVERLOADED_STATUS_CODES = [429, 503]
+# The function gave up on the report as its deadline passed
+DEADLINE_EXCEEDED_STATUS_CODE = 504
+# Response containing only the fields used here, with integer arrays instead of the
+# entity objects. The function compresses it with gzip, which requests decodes.
+COMPACT_MIMETYPE = "application/vnd.radgraph.compact+json"
+ACCEPT_HEADER = f"{COMPACT_MIMETYPE}, application/json;q=0.9"
+# Newline-delimited results of a batch, streamed as the reports are annotated
+NDJSON_MIMETYPE = "application/x-ndjson"
+STREAM_ACCEPT_HEADER = f"{NDJSON_MIMETYPE}, {COMPACT_MIMETYPE}"
+# Maximum number of kept-alive connections to the function, reports annotated
+# concurrently beyond it open short-lived connections
+HTTP_POOL_SIZE = 16
+# ID tokens are valid for an hour and are fetched again this many seconds before they
+# expire, so that no request is sent with a token that expires on the way
+ID_TOKEN_REFRESH_MARGIN_SEC = 300
+# Opt-in for the async client: if no response arrived after this percentile of the
+# recently observed latencies, a duplicate request is sent, the first response of both
+# is used and the other request is cancelled. 0 disables hedging.
+HEDGE_PERCENTILE = float(os.environ.get("RADGRAPH_HEDGE_PERCENTILE", 0))
+# Every request earns this fraction of a hedged request, which caps the additional load
+# of hedging also while the function is overloaded and every request is slow. Budget
+# that is not used can be saved up to HEDGE_MAX_BUDGET hedged requests.
+HEDGE_BUDGET_RATIO = float(os.environ.get("RADGRAPH_HEDGE_BUDGET_RATIO", 0.05))
+HEDGE_MAX_BUDGET = 10
+# Number of recent latencies the percentile is computed of, and that have to be observed
+# before the first request is hedged
+HEDGE_LATENCY_WINDOW = 200
+HEDGE_MIN_LATENCIES = 20
+# Called while the circuit breaker of the RadGraph function is open, e.g. another
+# deployment or the emulator. Calls fail fast if no fallback is configured or its
+# circuit breaker is open as well. ID tokens are only sent to https URLs.
+FALLBACK_URL = os.environ.get("RADGRAPH_FALLBACK_URL")
+
+# Shared by all calls, so that the connections to the function and to the metadata
+# server are kept alive instead of a TCP and TLS handshake for every report
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+
+# The async client keeps its connections alive as well, but is bound to the event loop
+# it is used on, hence there is one client per event loop
+__async_clients = weakref.WeakKeyDictionary()
+
+__id_token_lock = threading.Lock()
+# Token and expiry by audience
+__cached_id_tokens = {}
+
+__backends_lock = threading.Lock()
+__circuit_breakers = {}
+# Balancer by the endpoints it balances between
+__endpoint_balancers = {}
+
+__hedge_lock = threading.Lock()
+__latencies = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+__hedge_budget = 0.0
+
+
+class RadGraphOverloadedError(Exception):
+    def __init__(self, status_code: int, retry_after_sec: Optional[float]):
+        super().__init__(
+            f"RadGraph function is overloaded (status {status_code}), "
+            f"retry after {retry_after_sec} seconds"
+        )
+        self.status_code = status_code
+        self.retry_after_sec = retry_after_sec
+
+
+class RadGraphDeadlineExceededError(Exception):
+    pass
+
+
+# The circuit breakers of all backends are open, handled like an overloaded function
+class RadGraphUnavailableError(RadGraphOverloadedError):
+    pass
+
+
+# Any other error of a single report of a batch
+class RadGraphError(Exception):
+    def __init__(self, status_code: int, message: Optional[str]):
+        super().__init__(f"RadGraph function failed (status {status_code}): {message}")
+        self.status_code = status_code
+
+
+def __get_retry_after_sec(
+    response: Union[requests.Response, httpx.Response],
+) -> Optional[float]:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+# Concurrent callers wait for a single fetch of an expired token
+def __get_id_token(audience: str) -> str:
+    with __id_token_lock:
+        token, expiry = __cached_id_tokens.get(audience, (None, 0.0))
+        if time.time() >= expiry - ID_TOKEN_REFRESH_MARGIN_SEC:
+            token = id_token.fetch_id_token(Request(session), audience)
+            # The token is only read for its expiry, the function verifies it
+            expiry = jwt.decode(token, verify=False)["exp"]
+            __cached_id_tokens[audience] = (token, expiry)
+        return token
+
+
+# Errors that show that the backend is unavailable or degraded, in contrast to errors of
+# the request. A 429 or 504 of the function only rejects a request whose deadline is too
+# tight for a busy but healthy backend, hence only 5xx, connection errors and timeouts
+# count. A timeout of the client only counts if the call was slow, as most of the time
+# until the deadline may have been spent before the call, e.g. on the OpenAI validation.
+def __is_backend_failure(error: Exception, is_slow: bool) -> bool:
+    if isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)):
+        return error.response.status_code >= 500
+    if isinstance(error, RadGraphOverloadedError):
+        return error.status_code >= 500
+    if isinstance(error, RadGraphDeadlineExceededError):
+        return is_slow and isinstance(
+            error.__cause__, (requests.Timeout, httpx.TimeoutException)
+        )
+    return isinstance(
+        error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+    )
+
+
+def __get_circuit_breaker(url: str) -> CircuitBreaker:
+    with __backends_lock:
+        if url not in __circuit_breakers:
+            __circuit_breakers[url] = CircuitBreaker(url, __is_backend_failure)
+        return __circuit_breakers[url]
+
+
+def __get_endpoint_balancer() -> EndpointBalancer:
+    urls = (
+        [EMULATED_FUNCTION_URL]
+        if os.environ.get("RADGRAPH_EMULATED")
+        else RADGRAPH_FUNCTION_URLS
+    )
+    with __backends_lock:
+        if tuple(urls) not in __endpoint_balancers:
+            __endpoint_balancers[tuple(urls)] = EndpointBalancer(urls)
+        return __endpoint_balancers[tuple(urls)]
+
+
+# Latency and calls in flight of every endpoint
+def get_endpoint_stats() -> Dict[str, Dict[str, Any]]:
+    return __get_endpoint_balancer().stats()
+
+
+# Returns the URL of the first backend whose circuit breaker lets the call through, its
+# circuit breaker and whether the call is the probe of a half-open circuit breaker
+def __choose_backend(
+    endpoint_balancer: EndpointBalancer, deadline: Optional[float]
+) -> Tuple[str, CircuitBreaker, bool]:
+    # Checked before the call is observed by a circuit breaker, as a passed deadline is
+    # no failure of the backend
+    if deadline is not None and time.time() >= deadline:
+        raise RadGraphDeadlineExceededError()
+
+    urls = endpoint_balancer.order()
+    if FALLBACK_URL:
+        urls.append(FALLBACK_URL)
+
+    retry_after_sec = []
+    for url in urls:
+        circuit_breaker = __get_circuit_breaker(url)
+        is_probe = circuit_breaker.allow_call()
+        if is_probe is not None:
+            return url, circuit_breaker, is_probe
+        retry_after_sec.append(circuit_breaker.retry_after_sec())
+    raise RadGraphUnavailableError(503, min(retry_after_sec))
+
+
+# Yields the URL of the backend to call, whose latency and failures are observed
+# within the context
+@contextlib.contextmanager
+def __call_backend(deadline: Optional[float]):
+    endpoint_balancer = __get_endpoint_balancer()
+    url, circuit_breaker, is_probe = __choose_backend(endpoint_balancer, deadline)
+    with circuit_breaker.observe_call(is_probe), endpoint_balancer.track_call(url):
+        yield url
+
+
+# Returns the headers with the time remaining until the deadline and the timeout of the
+# request
+def __apply_deadline(
+    headers: dict, deadline: Optional[float]
+) -> Tuple[dict, Optional[float]]:
+    if deadline is None:
+        return headers, None
+    timeout_sec = deadline - time.time()
+    if timeout_sec <= 0:
+        raise RadGraphDeadlineExceededError()
+    return {**headers, DEADLINE_HEADER: f"{timeout_sec:.3f}"}, timeout_sec
+
+
+def __post_before_deadline(
+    url: str,
+    headers: dict,
+    payload: dict,
+    deadline: Optional[float],
+    stream: bool = False,
+) -> requests.Response:
+    headers, timeout_sec = __apply_deadline(headers, deadline)
+    try:
+        return session.post(
+            url, headers=headers, json=payload, timeout=timeout_sec, stream=stream
+        )
+    except requests.exceptions.Timeout as e:
+        raise RadGraphDeadlineExceededError() from e
+
+
+# Restores the shape of the full response, the entities only contain their indices
+def __expand_compact_response(compact_response: dict) -> dict:
+    entity_spans = compact_response["entity_spans"]
+    radgraph_output = {
+        "radgraph_text": compact_response["radgraph_text"],
+        "processed_annotations": compact_response["processed_annotations"],
+        "radgraph_annotations": {
+            "0": {
+                "entities": {
+                    str(span_index // 2 + 1): {
+                        "start_ix": entity_spans[span_index],
+                        "end_ix": entity_spans[span_index + 1],
+                    }
+                    for span_index in range(0, len(entity_spans), 2)
+                }
+            }
+        },
+    }
+    if "radgraph_token_offsets" in compact_response:
+        token_offsets = compact_response["radgraph_token_offsets"]
+        radgraph_output["radgraph_token_offsets"] = [
+            None
+            if token_offsets[offset_index] == -1
+            else token_offsets[offset_index : offset_index + 2]
+            for offset_index in range(0, len(token_offsets), 2)
+        ]
+    return radgraph_output
+
+
+def __get_batch_item_error(item: Dict[str, Any]) -> Exception:
+    status_code = item["status"]
+    if status_code in OVERLOADED_STATUS_CODES:
+        retry_after_sec = item.get("retry_after")
+        return RadGraphOverloadedError(
+            status_code, float(retry_after_sec) if retry_after_sec is not None else None
+        )
+    if status_code == DEADLINE_EXCEEDED_STATUS_CODE:
+        return RadGraphDeadlineExceededError()
+    return RadGraphError(status_code, item.get("error"))
+
+
+def __get_batch_item_result(
+    item: Dict[str, Any], is_compact_response: bool
+) -> Union[Dict[str, Any], Exception]:
+    if item["status"] != 200:
+        return __get_batch_item_error(item)
+    if is_compact_response:
+        return __expand_compact_response(item["result"])
+    return item["result"]
+
+
+# Works with the responses of both requests and httpx
+def __raise_for_radgraph_status(response: Union[requests.Response, httpx.Response]):
+    if response.status_code in OVERLOADED_STATUS_CODES:
+        raise RadGraphOverloadedError(
+            response.status_code, __get_retry_after_sec(response)
+        )
+    if response.status_code == DEADLINE_EXCEEDED_STATUS_CODE:
+        raise RadGraphDeadlineExceededError()
     response.raise_for_status()
+
+
+def __post_to_radgraph(
+    path: str,
+    payload: dict,
+    deadline: Optional[float],
+    accept: str = ACCEPT_HEADER,
+    stream: bool = False,
+) -> requests.Response:
+    with __call_backend(deadline) as url:
+        headers = {"Accept": accept}
+        if url.startswith("https://"):
+            headers["Authorization"] = f"Bearer {__get_id_token(url)}"
+        response = __post_before_deadline(
+            url + path, headers, payload, deadline, stream
+        )
+        __raise_for_radgraph_status(response)
+    return response
+
+
+def __get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    if loop not in __async_clients:
+        __async_clients[loop] = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=HTTP_POOL_SIZE)
+        )
+    return __async_clients[loop]
+
+
+# Cancelling the returned coroutine, e.g. by asyncio.wait_for, closes the connection and
+# the function stops working on the report once the deadline sent along passed
+async def __post_to_radgraph_async(
+    path: str, payload: dict, deadline: Optional[float]
+) -> httpx.Response:
+    with __call_backend(deadline) as url:
+        headers = {"Accept": ACCEPT_HEADER}
+        if url.startswith("https://"):
+            # Only blocks while an expired token is fetched again
+            token = await asyncio.get_running_loop().run_in_executor(
+                None, __get_id_token, url
+            )
+            headers["Authorization"] = f"Bearer {token}"
+
+        headers, timeout_sec = __apply_deadline(headers, deadline)
+        try:
+            response = await __get_async_client().post(
+                url + path, headers=headers, json=payload, timeout=timeout_sec
+            )
+        except httpx.TimeoutException as e:
+            raise RadGraphDeadlineExceededError() from e
+        __raise_for_radgraph_status(response)
+    return response
+
+
+def __record_latency(latency_sec: float):
+    with __hedge_lock:
+        __latencies.append(latency_sec)
+
+
+# Returns None if the request is not hedged. Every request earns its share of the budget.
+def __get_hedge_delay_sec() -> Optional[float]:
+    global __hedge_budget
+    if HEDGE_PERCENTILE <= 0:
+        return None
+    with __hedge_lock:
+        __hedge_budget = min(__hedge_budget + HEDGE_BUDGET_RATIO, HEDGE_MAX_BUDGET)
+        if len(__latencies) < HEDGE_MIN_LATENCIES:
+            return None
+        latencies = sorted(__latencies)
+    return latencies[
+        min(int(len(latencies) * HEDGE_PERCENTILE / 100), len(latencies) - 1)
+    ]
+
+
+def __try_spend_hedge_budget() -> bool:
+    global __hedge_budget
+    with __hedge_lock:
+        if __hedge_budget < 1:
+            return False
+        __hedge_budget -= 1
+        return True
+
+
+# Returns the first successful response, or raises the error of the first request if
+# both failed
+async def __get_first_response(requests_sent: List[asyncio.Task]) -> httpx.Response:
+    pending = set(requests_sent)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for request in done:
+                if request.exception() is None:
+                    return request.result()
+        return requests_sent[0].result()
+    finally:
+        for request in pending:
+            request.cancel()
+
+
+async def __post_to_radgraph_hedged(
+    path: str, payload: dict, deadline: Optional[float]
+) -> httpx.Response:
+    hedge_delay_sec = __get_hedge_delay_sec()
+    start = time.monotonic()
+    requests_sent = [
+        asyncio.ensure_future(__post_to_radgraph_async(path, payload, deadline))
+    ]
+    try:
+        if hedge_delay_sec is not None:
+            await asyncio.wait(requests_sent, timeout=hedge_delay_sec)
+            if not requests_sent[0].done() and __try_spend_hedge_budget():
+                requests_sent.append(
+                    asyncio.ensure_future(
+                        __post_to_radgraph_async(path, payload, deadline)
+                    )
+                )
+        response = await __get_first_response(requests_sent)
+    finally:
+        # Also cancels the requests if the caller is cancelled
+        for request in requests_sent:
+            request.cancel()
+    __record_latency(time.monotonic() - start)
+    return response
+
+
+def __is_in_process_backend() -> bool:
+    return os.environ.get("RADGRAPH_BACKEND") == IN_PROCESS_BACKEND
+
+
+# The in-process backend cannot stop annotating once the deadline passed, it only does
+# not start after it
+def __annotate_in_process(
+    user_reports: List[str], deadline: Optional[float]
+) -> List[Dict[str, Any]]:
+    if deadline is not None and time.time() >= deadline:
+        raise RadGraphDeadlineExceededError()
+    return annotate_reports_in_process(user_reports)
+
+
+def __is_compact_response(response: Union[requests.Response, httpx.Response]) -> bool:
+    return response.headers.get("Content-Type", "").startswith(COMPACT_MIMETYPE)
+
+
+# deadline is the time.time() after which the caller no longer needs the annotations
+def get_processed_annotation_from_radgraph(
+    user_report: str, deadline: Optional[float] = None
+):
+    if __is_in_process_backend():
+        return __annotate_in_process([user_report], deadline)[0]
+
+    # The offsets of the tokens in the report spare aligning them in the text mapping
+    payload = {"report": user_report, "include_offsets": True}
+    response = __post_to_radgraph("", payload, deadline)
+    if __is_compact_response(response):
+        return __expand_compact_response(response.json())
+    return response.json()
+
+
+# Like get_processed_annotation_from_radgraph, for callers running on an event loop
+async def get_processed_annotation_from_radgraph_async(
+    user_report: str, deadline: Optional[float] = None
+):
+    if __is_in_process_backend():
+        processed_annotations = await asyncio.get_running_loop().run_in_executor(
+            None, __annotate_in_process, [user_report], deadline
+        )
+        return processed_annotations[0]
+
+    payload = {"report": user_report, "include_offsets": True}
+    response = await __post_to_radgraph_hedged("", payload, deadline)
+    if __is_compact_response(response):
+        return __expand_compact_response(response.json())
     return response.json()
+
+
+# Annotates all reports in a single request. Returns the RadGraph output of every report
+# in the order of the reports, or the exception for reports that could not be annotated.
+# Errors of the request as a whole are raised.
+def get_processed_annotations_from_radgraph_batch(
+    user_reports: List[str], deadline: Optional[float] = None
+) -> List[Union[Dict[str, Any], Exception]]:
+    if __is_in_process_backend():
+        return __annotate_in_process(user_reports, deadline)
+
+    payload = {"reports": user_reports, "include_offsets": True}
+    response = __post_to_radgraph("/batch", payload, deadline)
+    is_compact_response = __is_compact_response(response)
+
+    return [
+        __get_batch_item_result(item, is_compact_response)
+        for item in response.json()["results"]
+    ]
+
+
+# Like get_processed_annotations_from_radgraph_batch, but yields the index of every
+# report with its output or exception as soon as the report is annotated, so that the
+# caller can process the first reports while the others are still being annotated.
+def stream_processed_annotations_from_radgraph_batch(
+    user_reports: List[str], deadline: Optional[float] = None
+) -> Iterator[Tuple[int, Union[Dict[str, Any], Exception]]]:
+    if __is_in_process_backend():
+        yield from enumerate(__annotate_in_process(user_reports, deadline))
+        return
+
+    payload = {"reports": user_reports, "include_offsets": True}
+    response = __post_to_radgraph(
+        "/batch", payload, deadline, accept=STREAM_ACCEPT_HEADER, stream=True
+    )
+    # The function marks compact results with a parameter of the content type
+    is_compact_response = "radgraph=compact" in response.headers.get("Content-Type", "")
+
+    with response:
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                item = json.loads(line)
+                yield item["index"], __get_batch_item_result(item, is_compact_response)
+        # Reading the stream fails with a connection error once the timeout passed
+        except requests.exceptions.ConnectionError as e:
+            if deadline is not None and time.time() >= deadline:
+                raise RadGraphDeadlineExceededError() from e
+            raise
@@ -0,0 +1,52 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import os
+import threading
+from typing import Any, Dict, List
+
+MODEL_TYPE = "radgraph-xl"
+# Directory the model and tokenizer are downloaded to on first use
+MODEL_CACHE_DIR = os.environ.get("RADGRAPH_MODEL_CACHE_DIR", "./")
+
+__model = None
+__model_lock = threading.Lock()
+# Reports of concurrent calls are annotated one call after the other, the model already
+# uses all cores for a single call
+__inference_lock = threading.Lock()
+
+
+# The radgraph package is only required by instances that use this backend, hence it is
+# imported and the model is loaded on first use, once per instance
+def __get_model():
+    global __model
+    with __model_lock:
+        if __model is None:
+            from radgraph import RadGraph
+
+            __model = RadGraph(
+                model_type=MODEL_TYPE,
+                model_cache_dir=MODEL_CACHE_DIR,
+                tokenizer_cache_dir=MODEL_CACHE_DIR,
+            )
+    return __model
+
+
+# Returns the same output as the RadGraph function for every report, without the token
+# offsets, hence the entities are mapped to the reports by aligning the tokens
+def annotate_reports_in_process(reports: List[str]) -> List[Dict[str, Any]]:
+    from radgraph import get_radgraph_processed_annotations
+
+    model = __get_model()
+    with __inference_lock:
+        annotations = model(reports)
+    # get_radgraph_processed_annotations only processes the report with the key "0"
+    return [
+        get_radgraph_processed_annotations({"0": annotations[str(report_index)]})
+        for report_index in range(len(reports))
+    ]
@@ -0,0 +1,139 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import asyncio
+import contextlib
+import json
+
+import pytest
+
+from function_implementation.radgraph import circuit_breaker
+from function_implementation.radgraph.circuit_breaker import (
+    CircuitBreaker,
+    CircuitState,
+)
+
+
+class BackendError(Exception):
+    pass
+
+
+@pytest.fixture
+def mocked_time(mocker):
+    mocked_time = mocker.patch("function_implementation.radgraph.circuit_breaker.time")
+    mocked_time.monotonic.return_value = 1000.0
+    return mocked_time
+
+
+@pytest.fixture
+def breaker(mocked_time):
+    return CircuitBreaker(
+        "<backend>",
+        lambda error, is_slow: isinstance(error, BackendError),
+        open_sec=30,
+    )
+
+
+def __call(breaker, error=None):
+    is_probe = breaker.allow_call()
+    assert is_probe is not None
+    with pytest.raises(type(error)) if error else contextlib.nullcontext():
+        with breaker.observe_call(is_probe):
+            if error:
+                raise error
+
+
+def __open(breaker):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        __call(breaker, BackendError())
+
+
+def test_opens_after_failures(breaker):
+    for _ in range(circuit_breaker.MIN_CALLS - 1):
+        __call(breaker, BackendError())
+    assert breaker.state == CircuitState.CLOSED
+
+    __call(breaker, BackendError())
+
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.allow_call() is None
+    assert breaker.retry_after_sec() == 30
+
+
+def test_other_errors_not_counted(breaker):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        __call(breaker, ValueError())
+
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.stats()["recent_calls"] == 0
+
+
+def test_slow_calls_counted(breaker, mocked_time):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        is_probe = breaker.allow_call()
+        with breaker.observe_call(is_probe):
+            mocked_time.monotonic.return_value += circuit_breaker.SLOW_CALL_SEC
+
+    assert breaker.state == CircuitState.OPEN
+
+
+def test_successes_keep_closed(breaker):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        __call(breaker)
+    for _ in range(circuit_breaker.MIN_CALLS - 1):
+        __call(breaker, BackendError())
+
+    assert breaker.state == CircuitState.CLOSED
+
+
+@pytest.mark.parametrize(
+    "probe_error,state",
+    [(None, CircuitState.CLOSED), (BackendError(), CircuitState.OPEN)],
+)
+def test_probe(breaker, mocked_time, probe_error, state):
+    __open(breaker)
+    mocked_time.monotonic.return_value += 30
+
+    is_probe = breaker.allow_call()
+    assert is_probe is True
+    assert breaker.state == CircuitState.HALF_OPEN
+    # Only a single probe at a time
+    assert breaker.allow_call() is None
+
+    __call_probe = (
+        pytest.raises(BackendError) if probe_error else contextlib.nullcontext()
+    )
+    with __call_probe:
+        with breaker.observe_call(is_probe):
+            if probe_error:
+                raise probe_error
+
+    assert breaker.state == state
+    assert breaker.stats()["transitions"]["half_open"] == 1
+
+
+def test_cancelled_probe_released(breaker, mocked_time):
+    __open(breaker)
+    mocked_time.monotonic.return_value += 30
+
+    is_probe = breaker.allow_call()
+    with pytest.raises(asyncio.CancelledError):
+        with breaker.observe_call(is_probe):
+            raise asyncio.CancelledError
+
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.allow_call() is True
+
+
+def test_transitions_logged(breaker, capsys):
+    __open(breaker)
+
+    log_entries = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert log_entries[0]["circuit_state"] == "open"
+    assert log_entries[0]["recent_calls"] == circuit_breaker.MIN_CALLS
+    assert log_entries[0]["recent_failures"] == circuit_breaker.MIN_CALLS
@@ -0,0 +1,109 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import asyncio
+
+import pytest
+
+from function_implementation.radgraph import endpoint_balancer
+from function_implementation.radgraph.endpoint_balancer import EndpointBalancer
+
+
+@pytest.fixture
+def mocked_time(mocker):
+    mocked_time = mocker.patch(
+        "function_implementation.radgraph.endpoint_balancer.time"
+    )
+    mocked_time.monotonic.return_value = 1000.0
+    return mocked_time
+
+
+def __observe(balancer, mocked_time, url, latency_sec):
+    with balancer.track_call(url):
+        mocked_time.monotonic.return_value += latency_sec
+
+
+def test_unobserved_endpoints_first(mocked_time):
+    balancer = EndpointBalancer(["<first>", "<second>"])
+    __observe(balancer, mocked_time, "<first>", 0.1)
+
+    assert balancer.order() == ["<second>", "<first>"]
+
+
+def test_lower_latency_first(mocked_time):
+    balancer = EndpointBalancer(["<fast>", "<slow>"])
+    __observe(balancer, mocked_time, "<fast>", 0.1)
+    __observe(balancer, mocked_time, "<slow>", 1.0)
+
+    assert balancer.order() == ["<fast>", "<slow>"]
+    assert balancer.stats()["<slow>"] == {"latency_sec": 1.0, "in_flight": 0}
+
+
+def test_in_flight_calls_counted(mocked_time):
+    balancer = EndpointBalancer(["<busy>", "<idle>"])
+    __observe(balancer, mocked_time, "<busy>", 0.1)
+    __observe(balancer, mocked_time, "<idle>", 0.15)
+
+    with balancer.track_call("<busy>"):
+        assert balancer.order() == ["<idle>", "<busy>"]
+
+
+def test_moving_average(mocked_time):
+    balancer = EndpointBalancer(["<endpoint>"])
+    __observe(balancer, mocked_time, "<endpoint>", 1.0)
+    __observe(balancer, mocked_time, "<endpoint>", 2.0)
+
+    assert balancer.stats()["<endpoint>"]["latency_sec"] == pytest.approx(
+        1.0 + endpoint_balancer.LATENCY_SMOOTHING
+    )
+
+
+def test_failure_penalty(mocked_time):
+    balancer = EndpointBalancer(["<endpoint>"])
+
+    with pytest.raises(RuntimeError):
+        with balancer.track_call("<endpoint>"):
+            raise RuntimeError
+
+    assert balancer.stats()["<endpoint>"] == {
+        "latency_sec": endpoint_balancer.FAILURE_PENALTY_SEC,
+        "in_flight": 0,
+    }
+
+
+def test_cancelled_call_lower_bound(mocked_time):
+    balancer = EndpointBalancer(["<endpoint>"])
+    __observe(balancer, mocked_time, "<endpoint>", 1.0)
+
+    with pytest.raises(asyncio.CancelledError):
+        with balancer.track_call("<endpoint>"):
+            mocked_time.monotonic.return_value += 0.5
+            raise asyncio.CancelledError
+
+    assert balancer.stats()["<endpoint>"]["latency_sec"] == 1.0
+
+
+def test_power_of_two_choices(mocker, mocked_time):
+    balancer = EndpointBalancer(["<a>", "<b>", "<c>"])
+    for url, latency_sec in [("<a>", 0.1), ("<b>", 0.2), ("<c>", 0.3)]:
+        __observe(balancer, mocked_time, url, latency_sec)
+    mocker.patch(
+        "function_implementation.radgraph.endpoint_balancer.random.sample",
+        return_value=["<c>", "<b>"],
+    )
+
+    assert balancer.order() == ["<b>", "<c>", "<a>"]
+
+
+def test_unknown_url_not_tracked(mocked_time):
+    balancer = EndpointBalancer(["<endpoint>"])
+
+    with balancer.track_call("<fallback>"):
+        pass
+
+    assert list(balancer.stats()) == ["<endpoint>"]
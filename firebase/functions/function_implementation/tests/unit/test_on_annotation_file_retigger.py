@@ -6,8 +6,8 @@
 # SPDX-License-Identifier: MIT
 #
 
+import asyncio
 import json
-import time
 from unittest.mock import ANY
 import pytest
 
@@ -324,6 +324,10 @@ def test_mocked_flow(mocker):
     mock_request.auth.uid = uid
     mock_request.data = {"file_name": report_uuid}
 
+    now = 1000.0
+    mocked_time = mocker.patch("function_implementation.compute_annotations.time")
+    mocked_time.time.return_value = now
+
     mock_has_consent = mocker.patch(
         "function_implementation.compute_annotations.has_consent",
         return_value=True,
@@ -400,7 +404,9 @@ def test_mocked_flow(mocker):
         {"user_provided_text": user_provided_report, "create_time": ANY},
     )
 
-    mocked_get_postprocessed_annotation.assert_called_once_with(user_provided_report)
+    mocked_get_postprocessed_annotation.assert_called_once_with(
+        user_provided_report, now + compute_annotations.COMPUTE_ANNOTATIONS_TIMEOUT_SEC
+    )
 
     mocked_request_report_validation_function.assert_called_once_with(
         user_provided_report
@@ -473,7 +479,7 @@ def test_runtime_error(mocker):
     mock_storage.bucket.return_value = mock_bucket
     mocker.patch("function_implementation.compute_annotations.storage", mock_storage)
 
-    def raise_error(_user_provided_report, _uid, _file_name, _meta_data_ref):
+    def raise_error(_user_provided_report, _uid, _file_name, _meta_data_ref, _deadline):
         raise RuntimeError
 
     mocked_compute_annotations = mocker.patch(
@@ -500,7 +506,7 @@ def test_runtime_error(mocker):
     )
 
     mocked_compute_annotations.assert_called_once_with(
-        user_provided_report, uid, report_uuid, mock_report_meta_data_ref
+        user_provided_report, uid, report_uuid, mock_report_meta_data_ref, ANY
     )
 
 
@@ -567,8 +573,8 @@ def test_timeout(mocker):
         0,
     )
 
-    def delay(_user_provided_report, _uid, _file_name, _meta_data_ref):
-        time.sleep(0.1)
+    async def delay(_user_provided_report, _uid, _file_name, _meta_data_ref, _deadline):
+        await asyncio.sleep(0.1)
 
     mocked_compute_annotations = mocker.patch(
         "function_implementation.compute_annotations.__compute_annotations",
@@ -593,5 +599,5 @@ def test_timeout(mocker):
     )
 
     mocked_compute_annotations.assert_called_once_with(
-        user_provided_report, uid, report_uuid, mock_report_meta_data_ref
+        user_provided_report, uid, report_uuid, mock_report_meta_data_ref, ANY
     )
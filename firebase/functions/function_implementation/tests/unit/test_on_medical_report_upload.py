@@ -6,9 +6,9 @@
 # SPDX-License-Identifier: MIT
 #
 
+import asyncio
 import json
 import pathlib
-import time
 from unittest.mock import ANY
 import pytest
 
@@ -17,6 +17,10 @@ from function_implementation.compute_annotations import (
     ErrorCode,
     on_medical_report_upload_impl,
 )
+from function_implementation.radgraph.radgraph_calling import (
+    RadGraphDeadlineExceededError,
+    RadGraphOverloadedError,
+)
 
 
 @pytest.mark.parametrize(
@@ -205,6 +209,10 @@ def test_mocked_flow(mocker):
     mock_event.data.name = f"users/{uid}/reports/{report_uuid}"
     mock_event.data.bucket = bucket
 
+    now = 1000.0
+    mocked_time = mocker.patch("function_implementation.compute_annotations.time")
+    mocked_time.time.return_value = now
+
     mock_has_consent = mocker.patch(
         "function_implementation.compute_annotations.has_consent",
         return_value=True,
@@ -257,7 +265,9 @@ def test_mocked_flow(mocker):
         {"user_provided_text": user_provided_report, "create_time": ANY},
     )
 
-    mocked_get_postprocessed_annotation.assert_called_once_with(user_provided_report)
+    mocked_get_postprocessed_annotation.assert_called_once_with(
+        user_provided_report, now + compute_annotations.COMPUTE_ANNOTATIONS_TIMEOUT_SEC
+    )
 
     mocked_request_report_validation_function.assert_called_once_with(
         user_provided_report
@@ -337,7 +347,7 @@ def test_runtime_error(mocker):
     )
 
     mocked_compute_annotations.assert_called_once_with(
-        user_provided_report, uid, report_uuid, mock_report_meta_data_ref
+        user_provided_report, uid, report_uuid, mock_report_meta_data_ref, ANY
     )
 
 
@@ -379,8 +389,8 @@ def test_timeout(mocker):
         0,
     )
 
-    def delay(_user_provided_report, _uid, _file_name):
-        time.sleep(0.1)
+    async def delay(_user_provided_report, _uid, _file_name, _meta_data_ref, _deadline):
+        await asyncio.sleep(0.1)
 
     mocked_compute_annotations = mocker.patch(
         "function_implementation.compute_annotations.__compute_annotations",
@@ -405,5 +415,73 @@ def test_timeout(mocker):
     )
 
     mocked_compute_annotations.assert_called_once_with(
-        user_provided_report, uid, report_uuid, mock_report_meta_data_ref
+        user_provided_report, uid, report_uuid, mock_report_meta_data_ref, ANY
+    )
+
+
+@pytest.mark.parametrize(
+    "radgraph_error",
+    [RadGraphOverloadedError(503, 5.0), RadGraphDeadlineExceededError()],
+)
+def test_radgraph_gave_up(mocker, radgraph_error):
+    bucket = "<bucket>"
+    uid = "<uid>"
+    report_uuid = "<report_uuid>"
+    user_provided_report = "<user_provided_report>"
+    mock_event = mocker.MagicMock()
+    mock_event.data.name = f"users/{uid}/reports/{report_uuid}"
+    mock_event.data.bucket = bucket
+
+    mock_has_consent = mocker.patch(
+        "function_implementation.compute_annotations.has_consent",
+        return_value=True,
+    )
+
+    mock_report_meta_data_ref = mocker.MagicMock()
+
+    mocked_get_report_from_cloud_storage_function = mocker.patch(
+        "function_implementation.compute_annotations.__get_report_from_cloud_storage",
+        return_value=user_provided_report,
+    )
+
+    mocked_set_report_meta_data_function = mocker.MagicMock(return_value=None)
+    mock_report_meta_data_ref.set = mocked_set_report_meta_data_function
+
+    mocked_update_report_meta_data_function = mocker.MagicMock(return_value=None)
+    mock_report_meta_data_ref.update = mocked_update_report_meta_data_function
+
+    mocker.patch(
+        "function_implementation.compute_annotations.__get_report_meta_data_ref",
+        return_value=mock_report_meta_data_ref,
+    )
+
+    def raise_radgraph_error(
+        _user_provided_report, _uid, _file_name, _report_meta_data_ref, _deadline
+    ):
+        raise radgraph_error
+
+    mocked_compute_annotations = mocker.patch(
+        "function_implementation.compute_annotations.__compute_annotations",
+        side_effect=raise_radgraph_error,
+    )
+
+    on_medical_report_upload_impl(mock_event)
+
+    mock_has_consent.assert_called_with(uid)
+    assert mock_has_consent.call_count == 1
+
+    mocked_get_report_from_cloud_storage_function.assert_called_once_with(
+        bucket, pathlib.PurePath(mock_event.data.name)
+    )
+
+    mocked_set_report_meta_data_function.assert_called_once_with(
+        {"user_provided_text": user_provided_report, "create_time": ANY},
+    )
+
+    mocked_update_report_meta_data_function.assert_called_once_with(
+        {"error_code": ErrorCode.TIMEOUT.value}
+    )
+
+    mocked_compute_annotations.assert_called_once_with(
+        user_provided_report, uid, report_uuid, mock_report_meta_data_ref, ANY
     )
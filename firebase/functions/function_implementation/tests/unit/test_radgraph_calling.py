@@ -0,0 +1,753 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import asyncio
+import base64
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import requests
+
+from function_implementation.radgraph import circuit_breaker, radgraph_calling
+from function_implementation.radgraph.circuit_breaker import CircuitState
+
+from function_implementation.radgraph.radgraph_calling import (
+    ACCEPT_HEADER,
+    COMPACT_MIMETYPE,
+    DEADLINE_HEADER,
+    EMULATED_FUNCTION_URL,
+    IN_PROCESS_BACKEND,
+    RADGRAPH_FUNCTION_URL,
+    STREAM_ACCEPT_HEADER,
+    RadGraphDeadlineExceededError,
+    RadGraphError,
+    RadGraphOverloadedError,
+    RadGraphUnavailableError,
+    get_processed_annotation_from_radgraph,
+    get_endpoint_stats,
+    get_processed_annotation_from_radgraph_async,
+    get_processed_annotations_from_radgraph_batch,
+    stream_processed_annotations_from_radgraph_batch,
+)
+
+
+# Every test starts with closed circuit breakers
+@pytest.fixture(autouse=True)
+def circuit_breakers(monkeypatch):
+    monkeypatch.setattr(radgraph_calling, "__circuit_breakers", {})
+    monkeypatch.setattr(radgraph_calling, "__endpoint_balancers", {})
+
+
+@pytest.fixture
+def emulated(monkeypatch, mocker):
+    monkeypatch.setenv("RADGRAPH_EMULATED", "1")
+    mocked_time = mocker.patch("function_implementation.radgraph.radgraph_calling.time")
+    mocked_time.time.return_value = 1000.0
+
+
+def test_deadline_header(mocker, emulated):
+    processed_annotations = {"processed_annotations": []}
+    mock_response = mocker.MagicMock(
+        status_code=200, headers={"Content-Type": "application/json"}
+    )
+    mock_response.json.return_value = processed_annotations
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    assert (
+        get_processed_annotation_from_radgraph("<report>", deadline=1012.5)
+        == processed_annotations
+    )
+
+    mock_post.assert_called_once_with(
+        EMULATED_FUNCTION_URL,
+        headers={"Accept": ACCEPT_HEADER, DEADLINE_HEADER: "12.500"},
+        json={"report": "<report>", "include_offsets": True},
+        timeout=12.5,
+        stream=False,
+    )
+
+
+def test_no_deadline(mocker, emulated):
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=200, headers={}),
+    )
+
+    get_processed_annotation_from_radgraph("<report>")
+
+    mock_post.assert_called_once_with(
+        EMULATED_FUNCTION_URL,
+        headers={"Accept": ACCEPT_HEADER},
+        json={"report": "<report>", "include_offsets": True},
+        timeout=None,
+        stream=False,
+    )
+
+
+@pytest.mark.parametrize(
+    "status_code,retry_after,retry_after_sec",
+    [(429, "3", 3.0), (503, "10", 10.0), (503, None, None)],
+)
+def test_overloaded(mocker, emulated, status_code, retry_after, retry_after_sec):
+    mock_response = mocker.MagicMock(
+        status_code=status_code,
+        headers={} if retry_after is None else {"Retry-After": retry_after},
+    )
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    with pytest.raises(RadGraphOverloadedError) as error:
+        get_processed_annotation_from_radgraph("<report>", deadline=1001.0)
+
+    assert error.value.status_code == status_code
+    assert error.value.retry_after_sec == retry_after_sec
+    mock_response.raise_for_status.assert_not_called()
+
+
+def test_deadline_passed(mocker, emulated):
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+    )
+
+    with pytest.raises(RadGraphDeadlineExceededError):
+        get_processed_annotation_from_radgraph("<report>", deadline=999.0)
+
+    mock_post.assert_not_called()
+
+
+def test_request_timeout(mocker, emulated):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        side_effect=requests.exceptions.ReadTimeout,
+    )
+
+    with pytest.raises(RadGraphDeadlineExceededError):
+        get_processed_annotation_from_radgraph("<report>", deadline=1010.0)
+
+
+def test_deadline_exceeded_by_function(mocker, emulated):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=504),
+    )
+
+    with pytest.raises(RadGraphDeadlineExceededError):
+        get_processed_annotation_from_radgraph("<report>", deadline=1010.0)
+
+
+def test_compact_response(mocker, emulated):
+    processed_annotations = [{"observation_start_ix": [1]}]
+    mock_response = mocker.MagicMock(
+        status_code=200, headers={"Content-Type": COMPACT_MIMETYPE}
+    )
+    mock_response.json.return_value = {
+        "radgraph_text": 'Lungs clear . "',
+        "processed_annotations": processed_annotations,
+        "entity_spans": [0, 0, 1, 1],
+        "radgraph_token_offsets": [0, 5, 6, 11, 11, 12, -1, -1],
+    }
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    assert get_processed_annotation_from_radgraph("<report>") == {
+        "radgraph_text": 'Lungs clear . "',
+        "processed_annotations": processed_annotations,
+        "radgraph_annotations": {
+            "0": {
+                "entities": {
+                    "1": {"start_ix": 0, "end_ix": 0},
+                    "2": {"start_ix": 1, "end_ix": 1},
+                }
+            }
+        },
+        "radgraph_token_offsets": [[0, 5], [6, 11], [11, 12], None],
+    }
+
+
+def test_batch(mocker, emulated):
+    first_result = {"processed_annotations": [1]}
+    second_result = {"processed_annotations": [2]}
+    mock_response = mocker.MagicMock(
+        status_code=200, headers={"Content-Type": "application/json"}
+    )
+    mock_response.json.return_value = {
+        "results": [
+            {"status": 200, "result": first_result},
+            {"status": 503, "error": "RadGraph queue is full", "retry_after": 4},
+            {"status": 504, "error": "Deadline"},
+            {"status": 200, "result": second_result},
+            {"status": 500, "error": "Failed"},
+        ]
+    }
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    results = get_processed_annotations_from_radgraph_batch(
+        ["<first>", "<second>", "<third>", "<fourth>", "<fifth>"], deadline=1010.0
+    )
+
+    mock_post.assert_called_once_with(
+        EMULATED_FUNCTION_URL + "/batch",
+        headers={"Accept": ACCEPT_HEADER, DEADLINE_HEADER: "10.000"},
+        json={
+            "reports": ["<first>", "<second>", "<third>", "<fourth>", "<fifth>"],
+            "include_offsets": True,
+        },
+        timeout=10.0,
+        stream=False,
+    )
+    assert results[0] == first_result
+    assert isinstance(results[1], RadGraphOverloadedError)
+    assert results[1].status_code == 503
+    assert results[1].retry_after_sec == 4.0
+    assert isinstance(results[2], RadGraphDeadlineExceededError)
+    assert results[3] == second_result
+    assert isinstance(results[4], RadGraphError)
+    assert results[4].status_code == 500
+
+
+def test_batch_compact_response(mocker, emulated):
+    mock_response = mocker.MagicMock(
+        status_code=200, headers={"Content-Type": COMPACT_MIMETYPE}
+    )
+    mock_response.json.return_value = {
+        "results": [
+            {
+                "status": 200,
+                "result": {
+                    "radgraph_text": "Lungs clear",
+                    "processed_annotations": [],
+                    "entity_spans": [0, 1],
+                },
+            }
+        ]
+    }
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    assert get_processed_annotations_from_radgraph_batch(["<report>"]) == [
+        {
+            "radgraph_text": "Lungs clear",
+            "processed_annotations": [],
+            "radgraph_annotations": {
+                "0": {"entities": {"1": {"start_ix": 0, "end_ix": 1}}}
+            },
+        }
+    ]
+
+
+def test_batch_overloaded(mocker, emulated):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=429, headers={"Retry-After": "2"}),
+    )
+
+    with pytest.raises(RadGraphOverloadedError):
+        get_processed_annotations_from_radgraph_batch(["<report>"])
+
+
+def test_stream_batch(mocker, emulated):
+    first_result = {"processed_annotations": [1]}
+    mock_response = mocker.MagicMock(
+        status_code=200, headers={"Content-Type": "application/x-ndjson"}
+    )
+    mock_response.__enter__.return_value = mock_response
+    mock_response.iter_lines.return_value = [
+        b'{"index":1,"status":504,"error":"Deadline"}',
+        b"",
+        b'{"index":0,"status":200,"result":{"processed_annotations":[1]}}',
+    ]
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    results = list(
+        stream_processed_annotations_from_radgraph_batch(
+            ["<first>", "<second>"], deadline=1010.0
+        )
+    )
+
+    mock_post.assert_called_once_with(
+        EMULATED_FUNCTION_URL + "/batch",
+        headers={"Accept": STREAM_ACCEPT_HEADER, DEADLINE_HEADER: "10.000"},
+        json={"reports": ["<first>", "<second>"], "include_offsets": True},
+        timeout=10.0,
+        stream=True,
+    )
+    assert results[0][0] == 1
+    assert isinstance(results[0][1], RadGraphDeadlineExceededError)
+    assert results[1] == (0, first_result)
+
+
+def test_stream_batch_compact_response(mocker, emulated):
+    mock_response = mocker.MagicMock(
+        status_code=200,
+        headers={"Content-Type": "application/x-ndjson; radgraph=compact"},
+    )
+    mock_response.iter_lines.return_value = [
+        b'{"index":0,"status":200,"result":{"radgraph_text":"Lungs",'
+        b'"processed_annotations":[],"entity_spans":[0,0]}}'
+    ]
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    assert list(stream_processed_annotations_from_radgraph_batch(["<report>"])) == [
+        (
+            0,
+            {
+                "radgraph_text": "Lungs",
+                "processed_annotations": [],
+                "radgraph_annotations": {
+                    "0": {"entities": {"1": {"start_ix": 0, "end_ix": 0}}}
+                },
+            },
+        )
+    ]
+
+
+def test_stream_batch_deadline_passed_while_reading(mocker, emulated):
+    mock_response = mocker.MagicMock(status_code=200, headers={})
+    mock_response.iter_lines.side_effect = requests.exceptions.ConnectionError
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+    mocked_time = mocker.patch("function_implementation.radgraph.radgraph_calling.time")
+    mocked_time.time.side_effect = [1000.0, 1011.0]
+
+    with pytest.raises(RadGraphDeadlineExceededError):
+        list(stream_processed_annotations_from_radgraph_batch(["<report>"], 1010.0))
+
+
+def __make_id_token(expiry: int) -> str:
+    header, payload = (
+        base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+        for part in ({"alg": "RS256"}, {"exp": expiry})
+    )
+    return f"{header}.{payload}.c2lnbmF0dXJl"
+
+
+@pytest.fixture
+def deployed(monkeypatch, mocker):
+    monkeypatch.delenv("RADGRAPH_EMULATED", raising=False)
+    monkeypatch.setattr(radgraph_calling, "__cached_id_tokens", {})
+    mocked_time = mocker.patch("function_implementation.radgraph.radgraph_calling.time")
+    mocked_time.time.return_value = 1000.0
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=200, headers={}),
+    )
+    return mocked_time
+
+
+def test_id_token_cached(mocker, deployed):
+    first_token = __make_id_token(4600)
+    mock_fetch = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.id_token.fetch_id_token",
+        return_value=first_token,
+    )
+
+    get_processed_annotation_from_radgraph("<report>")
+    deployed.time.return_value = 4000.0
+    get_processed_annotation_from_radgraph("<report>")
+
+    mock_fetch.assert_called_once_with(mocker.ANY, RADGRAPH_FUNCTION_URL)
+    for call in radgraph_calling.session.post.call_args_list:
+        assert call.kwargs["headers"]["Authorization"] == f"Bearer {first_token}"
+
+
+def test_id_token_refreshed_before_expiry(mocker, deployed):
+    first_token, second_token = __make_id_token(4600), __make_id_token(8200)
+    mock_fetch = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.id_token.fetch_id_token",
+        side_effect=[first_token, second_token],
+    )
+
+    get_processed_annotation_from_radgraph("<report>")
+    deployed.time.return_value = 4600 - radgraph_calling.ID_TOKEN_REFRESH_MARGIN_SEC
+    get_processed_annotation_from_radgraph("<report>")
+
+    assert mock_fetch.call_count == 2
+    assert (
+        radgraph_calling.session.post.call_args.kwargs["headers"]["Authorization"]
+        == f"Bearer {second_token}"
+    )
+
+
+def __mock_async_client(mocker, handler):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.__get_async_client",
+        side_effect=lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+def test_async_deadline_header(mocker, emulated):
+    requests_sent = []
+
+    def handler(request):
+        requests_sent.append(request)
+        return httpx.Response(200, json={"processed_annotations": []})
+
+    __mock_async_client(mocker, handler)
+
+    assert asyncio.run(
+        get_processed_annotation_from_radgraph_async("<report>", deadline=1012.5)
+    ) == {"processed_annotations": []}
+
+    (request,) = requests_sent
+    assert str(request.url) == EMULATED_FUNCTION_URL
+    assert request.headers["Accept"] == ACCEPT_HEADER
+    assert request.headers[DEADLINE_HEADER] == "12.500"
+    assert json.loads(request.content) == {
+        "report": "<report>",
+        "include_offsets": True,
+    }
+
+
+def test_async_overloaded(mocker, emulated):
+    __mock_async_client(
+        mocker, lambda request: httpx.Response(503, headers={"Retry-After": "7"})
+    )
+
+    with pytest.raises(RadGraphOverloadedError) as error:
+        asyncio.run(get_processed_annotation_from_radgraph_async("<report>"))
+
+    assert error.value.status_code == 503
+    assert error.value.retry_after_sec == 7.0
+
+
+def test_async_request_timeout(mocker, emulated):
+    def handler(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    __mock_async_client(mocker, handler)
+
+    with pytest.raises(RadGraphDeadlineExceededError):
+        asyncio.run(
+            get_processed_annotation_from_radgraph_async("<report>", deadline=1010.0)
+        )
+
+
+def test_async_cancelled_by_timeout(mocker, emulated):
+    cancelled_requests = []
+
+    async def handler(request):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled_requests.append(request)
+            raise
+
+    __mock_async_client(mocker, handler)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(
+            asyncio.wait_for(
+                get_processed_annotation_from_radgraph_async("<report>"), timeout=0.05
+            )
+        )
+
+    assert len(cancelled_requests) == 1
+
+
+@pytest.fixture
+def hedged(monkeypatch):
+    monkeypatch.setattr(radgraph_calling, "HEDGE_PERCENTILE", 90.0)
+    monkeypatch.setattr(
+        radgraph_calling,
+        "__latencies",
+        collections.deque([0.01] * radgraph_calling.HEDGE_MIN_LATENCIES),
+    )
+    monkeypatch.setattr(radgraph_calling, "__hedge_budget", 1.0)
+
+
+def __mock_slow_first_request(mocker, first_request_sec):
+    requests_sent = []
+    cancelled_requests = []
+
+    async def handler(request):
+        requests_sent.append(request)
+        try:
+            if len(requests_sent) == 1:
+                await asyncio.sleep(first_request_sec)
+            return httpx.Response(
+                200, json={"processed_annotations": [len(requests_sent)]}
+            )
+        except asyncio.CancelledError:
+            cancelled_requests.append(request)
+            raise
+
+    __mock_async_client(mocker, handler)
+    return requests_sent, cancelled_requests
+
+
+def test_hedged_request(mocker, emulated, hedged):
+    requests_sent, cancelled_requests = __mock_slow_first_request(mocker, 10)
+
+    assert asyncio.run(get_processed_annotation_from_radgraph_async("<report>")) == {
+        "processed_annotations": [2]
+    }
+
+    assert len(requests_sent) == 2
+    assert cancelled_requests == requests_sent[:1]
+
+
+def test_hedge_budget_exhausted(mocker, emulated, hedged, monkeypatch):
+    monkeypatch.setattr(radgraph_calling, "__hedge_budget", 0.0)
+    requests_sent, _ = __mock_slow_first_request(mocker, 0.1)
+
+    assert asyncio.run(get_processed_annotation_from_radgraph_async("<report>")) == {
+        "processed_annotations": [1]
+    }
+
+    assert len(requests_sent) == 1
+
+
+def test_fast_request_not_hedged(mocker, emulated, hedged):
+    requests_sent, _ = __mock_slow_first_request(mocker, 0)
+
+    asyncio.run(get_processed_annotation_from_radgraph_async("<report>"))
+
+    assert len(requests_sent) == 1
+    assert radgraph_calling.__hedge_budget == 1.0 + radgraph_calling.HEDGE_BUDGET_RATIO
+
+
+def test_hedged_request_failed(mocker, emulated, hedged):
+    requests_sent = []
+
+    async def handler(request):
+        requests_sent.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(503)
+
+    __mock_async_client(mocker, handler)
+
+    with pytest.raises(RadGraphOverloadedError):
+        asyncio.run(get_processed_annotation_from_radgraph_async("<report>"))
+
+    assert len(requests_sent) == 2
+
+
+@pytest.fixture
+def in_process(monkeypatch, mocker):
+    monkeypatch.setenv("RADGRAPH_BACKEND", IN_PROCESS_BACKEND)
+    mocked_time = mocker.patch("function_implementation.radgraph.radgraph_calling.time")
+    mocked_time.time.return_value = 1000.0
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post"
+    )
+    yield mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.annotate_reports_in_process",
+        side_effect=lambda reports: [{"radgraph_text": report} for report in reports],
+    )
+    mock_post.assert_not_called()
+
+
+def test_in_process_backend(in_process):
+    assert get_processed_annotation_from_radgraph("<report>", deadline=1010.0) == {
+        "radgraph_text": "<report>"
+    }
+    assert asyncio.run(get_processed_annotation_from_radgraph_async("<report>")) == {
+        "radgraph_text": "<report>"
+    }
+    assert get_processed_annotations_from_radgraph_batch(["<first>", "<second>"]) == [
+        {"radgraph_text": "<first>"},
+        {"radgraph_text": "<second>"},
+    ]
+    assert list(stream_processed_annotations_from_radgraph_batch(["<first>"])) == [
+        (0, {"radgraph_text": "<first>"})
+    ]
+
+
+def test_in_process_backend_deadline_passed(in_process):
+    with pytest.raises(RadGraphDeadlineExceededError):
+        get_processed_annotation_from_radgraph("<report>", deadline=1000.0)
+
+    in_process.assert_not_called()
+
+
+def __trip_circuit_breaker(mocker):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=503, headers={}),
+    )
+    for _ in range(circuit_breaker.MIN_CALLS):
+        with pytest.raises(RadGraphOverloadedError):
+            get_processed_annotation_from_radgraph("<report>")
+
+
+def test_circuit_breaker_fails_fast(mocker, emulated):
+    __trip_circuit_breaker(mocker)
+
+    with pytest.raises(RadGraphUnavailableError):
+        get_processed_annotation_from_radgraph("<report>")
+
+    assert radgraph_calling.session.post.call_count == circuit_breaker.MIN_CALLS
+    circuit_breakers = getattr(radgraph_calling, "__circuit_breakers")
+    assert circuit_breakers[EMULATED_FUNCTION_URL].state == CircuitState.OPEN
+
+
+def test_circuit_breaker_fallback(mocker, emulated, monkeypatch):
+    monkeypatch.setattr(radgraph_calling, "FALLBACK_URL", "http://fallback:5002")
+    __trip_circuit_breaker(mocker)
+    mock_response = mocker.MagicMock(status_code=200, headers={})
+    mock_response.json.return_value = {"processed_annotations": []}
+    mock_post = mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mock_response,
+    )
+
+    assert get_processed_annotation_from_radgraph("<report>") == {
+        "processed_annotations": []
+    }
+
+    mock_post.assert_called_once_with(
+        "http://fallback:5002",
+        headers={"Accept": ACCEPT_HEADER},
+        json={"report": "<report>", "include_offsets": True},
+        timeout=None,
+        stream=False,
+    )
+
+
+def test_circuit_breaker_ignores_passed_deadline(mocker, emulated):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        with pytest.raises(RadGraphDeadlineExceededError):
+            get_processed_annotation_from_radgraph("<report>", deadline=999.0)
+
+    assert getattr(radgraph_calling, "__circuit_breakers") == {}
+
+
+def test_circuit_breaker_ignores_rejected_deadlines(mocker, emulated):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=429, headers={"Retry-After": "2"}),
+    )
+    for _ in range(circuit_breaker.MIN_CALLS):
+        with pytest.raises(RadGraphOverloadedError):
+            get_processed_annotation_from_radgraph("<report>")
+
+    circuit_breakers = getattr(radgraph_calling, "__circuit_breakers")
+    assert circuit_breakers[EMULATED_FUNCTION_URL].state == CircuitState.CLOSED
+    assert circuit_breakers[EMULATED_FUNCTION_URL].stats()["recent_failures"] == 0
+
+
+def test_circuit_breaker_ignores_deadlines_exceeded_in_queue(mocker, emulated):
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        return_value=mocker.MagicMock(status_code=504, headers={}),
+    )
+    for _ in range(circuit_breaker.MIN_CALLS):
+        with pytest.raises(RadGraphDeadlineExceededError):
+            get_processed_annotation_from_radgraph("<report>", time.time() + 60)
+
+    circuit_breakers = getattr(radgraph_calling, "__circuit_breakers")
+    assert circuit_breakers[EMULATED_FUNCTION_URL].state == CircuitState.CLOSED
+    assert circuit_breakers[EMULATED_FUNCTION_URL].stats()["recent_failures"] == 0
+
+
+@pytest.mark.parametrize(
+    "call_sec, expected_state",
+    [(0.1, CircuitState.CLOSED), (circuit_breaker.SLOW_CALL_SEC, CircuitState.OPEN)],
+)
+def test_circuit_breaker_counts_slow_timeouts(
+    mocker, emulated, call_sec, expected_state
+):
+    mocked_time = mocker.patch("function_implementation.radgraph.circuit_breaker.time")
+    mocked_time.monotonic.return_value = 1000.0
+
+    def time_out(*args, **kwargs):
+        mocked_time.monotonic.return_value += call_sec
+        raise requests.exceptions.ReadTimeout()
+
+    mocker.patch(
+        "function_implementation.radgraph.radgraph_calling.session.post",
+        side_effect=time_out,
+    )
+    for _ in range(circuit_breaker.MIN_CALLS):
+        with pytest.raises(RadGraphDeadlineExceededError):
+            get_processed_annotation_from_radgraph("<report>", time.time() + 60)
+
+    circuit_breakers = getattr(radgraph_calling, "__circuit_breakers")
+    assert circuit_breakers[EMULATED_FUNCTION_URL].state == expected_state
+
+
+# Stand-in for a RadGraph deployment that answers after the given delay
+def __start_stand_in_server(delay_sec):
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            calls.append(self.path)
+            time.sleep(delay_sec)
+            body = json.dumps({"processed_annotations": []}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", calls
+
+
+def test_slow_endpoint_avoided(monkeypatch):
+    monkeypatch.delenv("RADGRAPH_EMULATED", raising=False)
+    fast_server, fast_url, fast_calls = __start_stand_in_server(0)
+    slow_server, slow_url, slow_calls = __start_stand_in_server(0.2)
+    monkeypatch.setattr(
+        radgraph_calling, "RADGRAPH_FUNCTION_URLS", [slow_url, fast_url]
+    )
+
+    try:
+        for _ in range(10):
+            get_processed_annotation_from_radgraph("<report>")
+    finally:
+        fast_server.shutdown()
+        slow_server.shutdown()
+
+    # The slow endpoint is only called until its latency was observed
+    assert len(slow_calls) == 1
+    assert len(fast_calls) == 9
+    assert get_endpoint_stats()[slow_url]["latency_sec"] >= 0.2
+
+
+def test_function_urls_are_stripped():
+    parse_function_urls = getattr(radgraph_calling, "__parse_function_urls")
+
+    assert parse_function_urls(
+        " https://a.test/radgraph , https://b.test/radgraph,"
+    ) == [
+        "https://a.test/radgraph",
+        "https://b.test/radgraph",
+    ]
+    assert parse_function_urls(RADGRAPH_FUNCTION_URL) == [RADGRAPH_FUNCTION_URL]
@@ -0,0 +1,50 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import sys
+
+import pytest
+
+from function_implementation.radgraph import radgraph_in_process
+from function_implementation.radgraph.radgraph_in_process import (
+    annotate_reports_in_process,
+)
+
+
+@pytest.fixture
+def mock_radgraph(mocker, monkeypatch):
+    monkeypatch.setattr(radgraph_in_process, "__model", None)
+    mock_module = mocker.MagicMock()
+    mock_module.RadGraph.return_value.side_effect = lambda reports: {
+        str(report_index): {"text": report}
+        for report_index, report in enumerate(reports)
+    }
+    mock_module.get_radgraph_processed_annotations.side_effect = lambda annotations: {
+        "radgraph_text": annotations["0"]["text"]
+    }
+    monkeypatch.setitem(sys.modules, "radgraph", mock_module)
+    return mock_module
+
+
+def test_annotate_reports(mock_radgraph):
+    assert annotate_reports_in_process(["<first>", "<second>"]) == [
+        {"radgraph_text": "<first>"},
+        {"radgraph_text": "<second>"},
+    ]
+    mock_radgraph.RadGraph.return_value.assert_called_once_with(["<first>", "<second>"])
+
+
+def test_model_loaded_once(mock_radgraph):
+    annotate_reports_in_process(["<first>"])
+    annotate_reports_in_process(["<second>"])
+
+    mock_radgraph.RadGraph.assert_called_once_with(
+        model_type="radgraph-xl",
+        model_cache_dir=radgraph_in_process.MODEL_CACHE_DIR,
+        tokenizer_cache_dir=radgraph_in_process.MODEL_CACHE_DIR,
+    )
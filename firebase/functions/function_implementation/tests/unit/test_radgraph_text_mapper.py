@@ -11,6 +11,12 @@ import json
 
 from function_implementation.text_mapping.radgraph_text_mapper import (
     __get_end_ix_for_start_ix,
+    __map_all_token_entities_to_text_ranges,
+    __map_radgraph_relevant_token_entities_by_cumulative_offsets,
+    __map_radgraph_relevant_token_entities_to_text_ranges,
+    add_end_ix_to_processed_annotations,
+    get_end_ix_by_start_ix,
+    get_entity_mapping_in_user_entered_text,
 )
 
 
@@ -19,4 +25,119 @@ def test():
         """{"radgraph_annotations": {"0": {"entities": {"1": {"tokens": "kidneys", "label": "Anatomy::definitely present", "start_ix": 25, "end_ix": 25, "relations": []}, "2": {"tokens": "normal", "label": "Observation::definitely present", "start_ix": 27, "end_ix": 27, "relations": [["located_at", "3"], ["located_at", "4"], ["located_at", "5"]]}}}}}"""
     )
 
-    __get_end_ix_for_start_ix(example_radgraph_annotations, 0)
+    __get_end_ix_for_start_ix(get_end_ix_by_start_ix(example_radgraph_annotations), 0)
+
+
+def test_end_ix_index():
+    radgraph_output = __get_example_radgraph_output()
+    radgraph_output["radgraph_annotations"]["0"]["entities"]["5"] = {
+        "start_ix": 7,
+        "end_ix": 7,
+    }
+
+    end_ix_by_start_ix = get_end_ix_by_start_ix(radgraph_output)
+    assert end_ix_by_start_ix == {1: 1, 3: 3, 5: 5, 7: 9}
+
+    processed_annotations = add_end_ix_to_processed_annotations(
+        radgraph_output["processed_annotations"], radgraph_output, end_ix_by_start_ix
+    )
+    assert [
+        processed_annotation["located_at_end_ix"]
+        for processed_annotation in processed_annotations
+    ] == [[[1]], [[5]]]
+
+
+def __get_example_radgraph_output():
+    return {
+        "radgraph_text": "The kidneys are normal . Liver ( mild ) lesion .",
+        "radgraph_annotations": {
+            "0": {
+                "entities": {
+                    "1": {"start_ix": 1, "end_ix": 1},
+                    "2": {"start_ix": 3, "end_ix": 3},
+                    "3": {"start_ix": 5, "end_ix": 5},
+                    "4": {"start_ix": 7, "end_ix": 9},
+                }
+            }
+        },
+        "processed_annotations": [
+            {
+                "observation_start_ix": [3],
+                "observation_end_ix": [3],
+                "located_at_start_ix": [[1]],
+            },
+            {
+                "observation_start_ix": [7],
+                "observation_end_ix": [9],
+                "located_at_start_ix": [[5]],
+            },
+        ],
+    }
+
+
+def test_text_mapping_from_token_offsets():
+    user_provided_text = "The  kidneys are normal.\nLiver (mild) lesion."
+    expected_text_mapping = get_entity_mapping_in_user_entered_text(
+        user_provided_text, __get_example_radgraph_output()
+    )
+
+    radgraph_output = __get_example_radgraph_output()
+    radgraph_output["radgraph_token_offsets"] = [
+        [0, 3],
+        [5, 12],
+        [13, 16],
+        [17, 23],
+        [23, 24],
+        [25, 30],
+        [31, 32],
+        [32, 36],
+        [36, 37],
+        [38, 44],
+        [44, 45],
+    ]
+    mock_text = "<text that would not align with the tokens>"
+    assert (
+        get_entity_mapping_in_user_entered_text(mock_text, radgraph_output)
+        == expected_text_mapping
+    )
+
+
+def test_text_mapping_falls_back_to_alignment():
+    user_provided_text = "The  kidneys are normal.\nLiver (mild) lesion."
+    expected_text_mapping = get_entity_mapping_in_user_entered_text(
+        user_provided_text, __get_example_radgraph_output()
+    )
+
+    radgraph_output = __get_example_radgraph_output()
+    radgraph_output["radgraph_token_offsets"] = [None] * 11
+    assert (
+        get_entity_mapping_in_user_entered_text(user_provided_text, radgraph_output)
+        == expected_text_mapping
+    )
+
+
+def test_alignment_skips_rewritten_tokens():
+    user_provided_text = "Liver “mild”\n\n lesion " + "-" * 300 + "."
+    total_tokens = ["Liver", '"', "mild", '"', "lesion", "."]
+
+    assert __map_all_token_entities_to_text_ranges(
+        total_tokens, user_provided_text
+    ) == {0: (0, 5), 2: (7, 11), 4: (15, 21)}
+
+
+def test_relevant_tokens_by_cumulative_offsets():
+    user_provided_text = "\n The  kidneys are normal.\nLiver (mild) lesion. \n"
+    total_tokens = __get_example_radgraph_output()["radgraph_text"].split(" ")
+    relevant_entities = [(1, 1), (3, 4), (7, 9), (10, 10)]
+
+    assert __map_radgraph_relevant_token_entities_by_cumulative_offsets(
+        total_tokens, user_provided_text, relevant_entities
+    ) == __map_radgraph_relevant_token_entities_to_text_ranges(
+        total_tokens, user_provided_text, relevant_entities
+    )
+    assert (
+        __map_radgraph_relevant_token_entities_by_cumulative_offsets(
+            total_tokens, user_provided_text.replace("(", "“"), relevant_entities
+        )
+        is None
+    )
@@ -6,19 +6,34 @@
 # SPDX-License-Identifier: MIT
 #
 
+import re
 import sys
 import traceback
-from typing import Any, Dict, List, Tuple, TypeVar
+from itertools import accumulate
+from typing import Any, Dict, List, Optional, Tuple, TypeVar
 
+# Maximum number of characters between two tokens in the user-provided text that are
+# searched for a token that does not directly follow the previous one
+MAX_TOKEN_GAP = 256
+WHITESPACE_PATTERN = re.compile(r"\s*")
 
-# Searching for the entity matching the start_idx and returing their end index
+
+# Mapping the start index of every entity to its end index, so that the end indices of
+# all relations are looked up in constant time instead of scanning the entities for each.
 # This is assuming that the start_idx is unique which is a fair assumption
-# as the are token-based
-def __get_end_ix_for_start_ix(radgraph_output: Dict[str, Any], start_idx: int) -> int:
-    entities = radgraph_output["radgraph_annotations"]["0"]["entities"]
-    for entity in entities:
-        if entities[entity]["start_ix"] == start_idx:
-            return entities[entity]["end_ix"]
+# as the are token-based, otherwise the first entity wins.
+def get_end_ix_by_start_ix(radgraph_output: Dict[str, Any]) -> Dict[int, int]:
+    end_ix_by_start_ix = {}
+    for entity in radgraph_output["radgraph_annotations"]["0"]["entities"].values():
+        end_ix_by_start_ix.setdefault(entity["start_ix"], entity["end_ix"])
+    return end_ix_by_start_ix
+
+
+def __get_end_ix_for_start_ix(
+    end_ix_by_start_ix: Dict[int, int], start_idx: int
+) -> Optional[int]:
+    if start_idx in end_ix_by_start_ix:
+        return end_ix_by_start_ix[start_idx]
 
     # Creating a traceback as this should never happen
     print(f"Matching end_idx not found for {start_idx}", file=sys.stderr)
@@ -27,18 +42,26 @@ def __get_end_ix_for_start_ix(radgraph_output: Dict[str, Any], start_idx: int) -
 
 
 # In order to restore the missing located_at_end_ix, we are using the entities array of the
-# raw radgraph output.
+# raw radgraph output. The RadGraph function already adds them if it is asked for offsets.
+# Callers that restore them for several passes over the same output can pass the index of
+# get_end_ix_by_start_ix, otherwise it is built if any annotation misses them.
 def add_end_ix_to_processed_annotations(
-    processed_annotations: Dict[str, Any], radgraph_output: Dict[str, Any]
+    processed_annotations: Dict[str, Any],
+    radgraph_output: Dict[str, Any],
+    end_ix_by_start_ix: Optional[Dict[int, int]] = None,
 ) -> List[List[int]]:
     for processed_annotation in processed_annotations:
+        if "located_at_end_ix" in processed_annotation:
+            continue
+        if end_ix_by_start_ix is None:
+            end_ix_by_start_ix = get_end_ix_by_start_ix(radgraph_output)
         located_at_start_observations = processed_annotation["located_at_start_ix"]
         located_at_end_observations = []
         for located_at_start_observation in located_at_start_observations:
             end_indices = []
             for start_idx in located_at_start_observation:
                 end_indices.append(
-                    __get_end_ix_for_start_ix(radgraph_output, start_idx)
+                    __get_end_ix_for_start_ix(end_ix_by_start_ix, start_idx)
                 )
             located_at_end_observations.append(end_indices)
         processed_annotation["located_at_end_ix"] = located_at_end_observations
@@ -46,34 +69,35 @@ def add_end_ix_to_processed_annotations(
 
 
 # Creating a dictionary that maps all tokens used by radgraph in the user-provided text to ranges
-# in the user-provided text
+# in the user-provided text. The tokens usually follow each other only separated by whitespace,
+# so every token is first compared at the next non-whitespace character. Tokens that do not
+# start there are searched within the next MAX_TOKEN_GAP characters, and skipped if the
+# RadGraph tokenizer rewrote them, so that the text is never scanned more than a bounded
+# number of characters ahead per token and the following tokens are still aligned.
 def __map_all_token_entities_to_text_ranges(
     total_tokens: List[str], user_provided_text: str
-) -> Dict[int, Tuple[int, int, str]]:
+) -> Dict[int, Tuple[int, int]]:
     total_entities_to_text_ranges_dict = {}
 
     text_pointer = 0
     for token_index, token in enumerate(total_tokens):
-        while text_pointer < len(user_provided_text):
-            next_text_pointer = 0
-
-            while (
-                next_text_pointer < len(token)
-                and next_text_pointer + text_pointer < len(user_provided_text)
-                and token[next_text_pointer]
-                == user_provided_text[text_pointer + next_text_pointer]
-            ):
-                next_text_pointer += 1
-
-            if next_text_pointer >= len(token):
-                total_entities_to_text_ranges_dict[token_index] = (
-                    text_pointer,
-                    text_pointer + next_text_pointer,
-                )
-
-                text_pointer += next_text_pointer
-                break
+        while (
+            text_pointer < len(user_provided_text)
+            and user_provided_text[text_pointer].isspace()
+        ):
             text_pointer += 1
+
+        if user_provided_text.startswith(token, text_pointer):
+            token_start = text_pointer
+        else:
+            token_start = user_provided_text.find(
+                token, text_pointer, text_pointer + MAX_TOKEN_GAP + len(token)
+            )
+            if token_start == -1:
+                continue
+
+        text_pointer = token_start + len(token)
+        total_entities_to_text_ranges_dict[token_index] = (token_start, text_pointer)
     return total_entities_to_text_ranges_dict
 
 
@@ -88,6 +112,8 @@ def __map_radgraph_relevant_token_entities_to_text_ranges(
     relevant_radgraph_entities_to_text_ranges_dict = {}
     for entity_start, entity_end in radgraph_relevant_entities:
         for token_index in range(entity_start, entity_end + 1):
+            if token_index not in total_entities_to_text_ranges_dict:
+                continue
             start_idx, end_idx = total_entities_to_text_ranges_dict[token_index]
             relevant_radgraph_entities_to_text_ranges_dict[token_index] = {
                 "user_provided_text_start": start_idx,
@@ -96,6 +122,86 @@ def __map_radgraph_relevant_token_entities_to_text_ranges(
     return relevant_radgraph_entities_to_text_ranges_dict
 
 
+# If the user-provided text only differs from the RadGraph text in its whitespace, which is
+# checked without aligning the tokens, a token starts after as many non-whitespace characters
+# as the tokens before it are long. Hence only the relevant tokens are located, in order, by
+# counting the non-whitespace characters of the text in between with string operations
+# instead of aligning every token, so that long reports with few findings are mapped
+# proportionally faster. Returns None otherwise, so that all tokens are aligned.
+def __map_radgraph_relevant_token_entities_by_cumulative_offsets(
+    total_tokens: List[str],
+    user_provided_text: str,
+    radgraph_relevant_entities: List[Tuple[int, int]],
+) -> Optional[Dict[int, Dict[str, int]]]:
+    if "".join(user_provided_text.split()) != "".join(total_tokens):
+        return None
+
+    token_offsets = list(accumulate(map(len, total_tokens), initial=0))
+    relevant_token_indices = sorted(
+        {
+            token_index
+            for entity_start, entity_end in radgraph_relevant_entities
+            for token_index in range(entity_start, entity_end + 1)
+            if token_index < len(total_tokens)
+        }
+    )
+
+    total_entities_to_text_ranges_dict = {}
+    text_pointer = 0
+    # Number of non-whitespace characters before the text pointer
+    non_whitespace_count = 0
+    for token_index in relevant_token_indices:
+        while True:
+            text_pointer = WHITESPACE_PATTERN.match(
+                user_provided_text, text_pointer
+            ).end()
+            missing_count = token_offsets[token_index] - non_whitespace_count
+            if missing_count == 0:
+                break
+            # At most missing_count of the next characters are non-whitespace
+            next_text_pointer = text_pointer + missing_count
+            non_whitespace_count += len(
+                "".join(user_provided_text[text_pointer:next_text_pointer].split())
+            )
+            text_pointer = next_text_pointer
+        total_entities_to_text_ranges_dict[token_index] = (
+            text_pointer,
+            text_pointer + len(total_tokens[token_index]),
+        )
+
+    relevant_radgraph_entities_to_text_ranges_dict = {}
+    for entity_start, entity_end in radgraph_relevant_entities:
+        for token_index in range(entity_start, entity_end + 1):
+            if token_index not in total_entities_to_text_ranges_dict:
+                continue
+            start_idx, end_idx = total_entities_to_text_ranges_dict[token_index]
+            relevant_radgraph_entities_to_text_ranges_dict[token_index] = {
+                "user_provided_text_start": start_idx,
+                "user_provided_text_end": end_idx,
+            }
+    return relevant_radgraph_entities_to_text_ranges_dict
+
+
+# Looking up the ranges of the relevant tokens in the per-token offsets computed by the
+# RadGraph function. Returns None if a relevant token has no offset, e.g. because the
+# RadGraph tokenizer rewrote it, so that the tokens are aligned with the text instead.
+def __map_radgraph_relevant_token_entities_to_offsets(
+    token_offsets: List[Optional[List[int]]],
+    radgraph_relevant_entities: List[Tuple[int, int]],
+) -> Optional[Dict[int, Dict[str, int]]]:
+    relevant_radgraph_entities_to_text_ranges_dict = {}
+    for entity_start, entity_end in radgraph_relevant_entities:
+        for token_index in range(entity_start, entity_end + 1):
+            if token_index >= len(token_offsets) or token_offsets[token_index] is None:
+                return None
+            start_idx, end_idx = token_offsets[token_index]
+            relevant_radgraph_entities_to_text_ranges_dict[token_index] = {
+                "user_provided_text_start": start_idx,
+                "user_provided_text_end": end_idx,
+            }
+    return relevant_radgraph_entities_to_text_ranges_dict
+
+
 T = TypeVar("T")
 
 
@@ -105,10 +211,12 @@ def __flat(list_of_list: List[List[T]]) -> List[T]:
 
 
 def get_entity_mapping_in_user_entered_text(
-    user_provided_text: str, radgraph_output: Dict[str, Any]
+    user_provided_text: str,
+    radgraph_output: Dict[str, Any],
+    end_ix_by_start_ix: Optional[Dict[int, int]] = None,
 ) -> Dict[int, Dict[str, int]]:
     processed_annotations = add_end_ix_to_processed_annotations(
-        radgraph_output["processed_annotations"], radgraph_output
+        radgraph_output["processed_annotations"], radgraph_output, end_ix_by_start_ix
     )
 
     radgraph_text = radgraph_output["radgraph_text"]
@@ -133,6 +241,23 @@ def get_entity_mapping_in_user_entered_text(
     # Removing duplicates
     radgraph_relevant_entities = list(set(observations + relations))
 
+    if "radgraph_token_offsets" in radgraph_output:
+        radgraph_relevant_entities_to_text_ranges_mapping = (
+            __map_radgraph_relevant_token_entities_to_offsets(
+                radgraph_output["radgraph_token_offsets"], radgraph_relevant_entities
+            )
+        )
+        if radgraph_relevant_entities_to_text_ranges_mapping is not None:
+            return radgraph_relevant_entities_to_text_ranges_mapping
+
+    radgraph_relevant_entities_to_text_ranges_mapping = (
+        __map_radgraph_relevant_token_entities_by_cumulative_offsets(
+            total_tokens, user_provided_text, radgraph_relevant_entities
+        )
+    )
+    if radgraph_relevant_entities_to_text_ranges_mapping is not None:
+        return radgraph_relevant_entities_to_text_ranges_mapping
+
     radgraph_relevant_entities_to_text_ranges_mapping = (
         __map_radgraph_relevant_token_entities_to_text_ranges(
             total_tokens, user_provided_text, radgraph_relevant_entities
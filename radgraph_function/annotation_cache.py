@@ -0,0 +1,118 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+
+# RadGraph splits reports on whitespace, hence reports that only differ in whitespace
+# result in the same annotations
+def normalize_report(report: str) -> str:
+    return " ".join(report.split())
+
+
+# Caches the processed annotations by the hash of the normalized report. The in-memory
+# tier is a bounded LRU, the optional on-disk tier stores one JSON file per report and
+# survives restarts of the function. The namespace has to change whenever the model
+# output changes, e.g. for another model type or annotation mode, to not serve stale
+# disk entries.
+class AnnotationCache:
+    def __init__(
+        self, namespace: str, max_entries: int, disk_dir: Optional[str] = None
+    ):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.disk_dir = pathlib.Path(disk_dir) if disk_dir else None
+
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    def key(self, report: str) -> str:
+        return hashlib.sha256(
+            f"{self.namespace}\0{normalize_report(report)}".encode()
+        ).hexdigest()
+
+    def get(self, report: str) -> Optional[Any]:
+        key = self.key(report)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._memory_hits += 1
+                return self._entries[key]
+
+        value = self._read_from_disk(key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+            self._store_in_memory(key, value)
+        return value
+
+    def put(self, report: str, value: Any) -> None:
+        key = self.key(report)
+        with self._lock:
+            self._store_in_memory(key, value)
+        self._write_to_disk(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "entries": len(self._entries),
+            }
+
+    def _store_in_memory(self, key: str, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> pathlib.Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _read_from_disk(self, key: str) -> Optional[Any]:
+        if self.disk_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # Writing to a temporary file first, so that concurrent readers and crashes never
+    # observe partially written entries
+    def _write_to_disk(self, key: str, value: Any) -> None:
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        temporary_path = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(value, file)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            print(f"Writing cache entry {key} failed: {e}", file=sys.stderr)
+            if temporary_path is not None and os.path.exists(temporary_path):
+                os.remove(temporary_path)
@@ -0,0 +1,204 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import math
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from metrics import Histogram
+
+
+# Weight of the latest batch in the moving average of the batch duration
+BATCH_DURATION_SMOOTHING = 0.2
+
+
+# Set on the future of a report whose deadline passed before its batch started
+class DeadlineExceededError(Exception):
+    pass
+
+
+class PendingReport(NamedTuple):
+    report: str
+    future: Future
+    submitted_at: float
+    # time.monotonic() after which nobody waits for the result anymore
+    deadline: Optional[float]
+
+    def is_expired(self, now: float) -> bool:
+        return self.deadline is not None and now > self.deadline
+
+
+# Collects reports submitted by concurrent requests and runs them through the model
+# as a single batch. A batch is closed as soon as max_batch_size reports are pending
+# or max_wait_sec has passed since the first report of the batch arrived.
+# run_batch receives the reports of a batch and a function that tells whether all of
+# them have passed their deadline, in which case the batch may be aborted by raising.
+class MicroBatcher:
+    def __init__(
+        self,
+        run_batch: Callable[[List[str], Callable[[], bool]], List[Any]],
+        max_batch_size: int,
+        max_wait_sec: float,
+        queue_wait_histogram: Optional[Histogram] = None,
+        batch_size_histogram: Optional[Histogram] = None,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_sec = max(0.0, max_wait_sec)
+        self.queue_wait_histogram = queue_wait_histogram
+        self.batch_size_histogram = batch_size_histogram
+
+        self._pending: List[PendingReport] = []
+        self._condition = threading.Condition()
+        self._worker = None
+        self._is_batch_running = False
+        self._batch_duration_sec: Optional[float] = None
+
+    def submit(self, report: str, deadline: Optional[float] = None) -> Future:
+        future = Future()
+        with self._condition:
+            self._ensure_worker()
+            self._pending.append(
+                PendingReport(report, future, time.monotonic(), deadline)
+            )
+            self._condition.notify()
+        return future
+
+    # Number of reports waiting for a batch, excluding the batch that is running
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def __call__(self, report: str, deadline: Optional[float] = None) -> Any:
+        return self.submit(report, deadline).result()
+
+    # Estimates the time until the result of a report submitted now is available from the
+    # moving average of the batch duration, the running batch and the batches ahead in the
+    # queue. Returns None as long as no batch has finished.
+    def estimate_wait_sec(self) -> Optional[float]:
+        with self._condition:
+            if self._batch_duration_sec is None:
+                return None
+            batch_count = math.ceil((len(self._pending) + 1) / self.max_batch_size)
+            if self._is_batch_running:
+                batch_count += 1
+            return self.max_wait_sec + batch_count * self._batch_duration_sec
+
+    # The worker thread is started lazily so that the batcher can be created at import
+    # time and still work in processes forked after the import.
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._worker = threading.Thread(target=self._run_forever, daemon=True)
+        self._worker.start()
+
+    def _next_batch(self) -> List[PendingReport]:
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            batch_deadline = time.monotonic() + self.max_wait_sec
+            while len(self._pending) < self.max_batch_size:
+                remaining_sec = batch_deadline - time.monotonic()
+                if remaining_sec <= 0:
+                    break
+                self._condition.wait(remaining_sec)
+
+            batch = self._pending[: self.max_batch_size]
+            del self._pending[: self.max_batch_size]
+            return batch
+
+    def _finish_batch(self, duration_sec: float) -> None:
+        with self._condition:
+            self._is_batch_running = False
+            if self._batch_duration_sec is None:
+                self._batch_duration_sec = duration_sec
+            else:
+                self._batch_duration_sec += BATCH_DURATION_SMOOTHING * (
+                    duration_sec - self._batch_duration_sec
+                )
+
+    def _run_forever(self) -> None:
+        while True:
+            batch = []
+            for pending_report in self._next_batch():
+                if not pending_report.future.set_running_or_notify_cancel():
+                    continue
+                if pending_report.is_expired(time.monotonic()):
+                    pending_report.future.set_exception(DeadlineExceededError())
+                    continue
+                batch.append(pending_report)
+            if not batch:
+                continue
+
+            with self._condition:
+                self._is_batch_running = True
+            started_at = time.monotonic()
+            if self.queue_wait_histogram is not None:
+                for pending_report in batch:
+                    self.queue_wait_histogram.observe(
+                        started_at - pending_report.submitted_at
+                    )
+            if self.batch_size_histogram is not None:
+                self.batch_size_histogram.observe(len(batch))
+
+            def is_batch_expired(batch=batch):
+                now = time.monotonic()
+                return all(pending_report.is_expired(now) for pending_report in batch)
+
+            try:
+                results = self.run_batch(
+                    [pending_report.report for pending_report in batch],
+                    is_batch_expired,
+                )
+            except Exception as e:
+                self._finish_batch(time.monotonic() - started_at)
+                for pending_report in batch:
+                    pending_report.future.set_exception(e)
+                continue
+            self._finish_batch(time.monotonic() - started_at)
+
+            for pending_report, result in zip(batch, results):
+                pending_report.future.set_result(result)
+
+
+# Sorts the reports by their token length and groups them into buckets of similar
+# length, so that short reports are not padded to the length of the longest report of
+# the batch. The split points minimize the padded tokens plus a fixed overhead per model
+# call, expressed in tokens. The padded size of a bucket, i.e. the number of reports
+# times the longest report, never exceeds max_batch_tokens unless a single report does.
+# Returns the report indices of every bucket to restore the original order afterwards.
+def split_into_length_buckets(
+    token_lengths: List[int], max_batch_tokens: int, call_overhead_tokens: int
+) -> List[List[int]]:
+    order = sorted(range(len(token_lengths)), key=token_lengths.__getitem__)
+    sorted_lengths = [token_lengths[report_index] for report_index in order]
+
+    # costs[end] is the minimal cost of bucketing the first end sorted reports and
+    # bucket_starts[end] is the start of the last bucket of that solution
+    costs = [0] + [math.inf] * len(order)
+    bucket_starts = [0] * (len(order) + 1)
+    for end in range(1, len(order) + 1):
+        for start in range(end - 1, -1, -1):
+            padded_tokens = (end - start) * sorted_lengths[end - 1]
+            if end - start > 1 and padded_tokens > max_batch_tokens:
+                break
+            cost = costs[start] + padded_tokens + call_overhead_tokens
+            if cost < costs[end]:
+                costs[end] = cost
+                bucket_starts[end] = start
+
+    buckets = []
+    end = len(order)
+    while end > 0:
+        start = bucket_starts[end]
+        buckets.append(order[start:end])
+        end = start
+    return buckets[::-1]
@@ -0,0 +1,78 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Measures the time from starting a fresh Python process to the first completed inference
+# when constructing RadGraph from the downloaded archive and when loading the model
+# stored by setup.py with memory mapped weights. Run setup.py first.
+#
+# Usage (from the radgraph_function directory):
+#   python -m benchmarks.benchmark_cold_start [--runs 3]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from model_loading import get_serialized_model_path
+
+# Prints the timestamps after main is imported and after the first report is annotated
+COLD_START_SCRIPT = """
+import time
+import main
+imported = time.time()
+main.batcher("IMPRESSION: No acute cardiopulmonary abnormality.")
+print(imported, time.time())
+"""
+
+
+def measure_cold_start(serialized_model_path):
+    environment = {
+        **os.environ,
+        "RADGRAPH_SERIALIZED_MODEL": serialized_model_path,
+        "RADGRAPH_CACHE_DIR": "",
+        # The first inference is measured cold, not racing or waiting for a warmup
+        "RADGRAPH_WARMUP": "0",
+    }
+    process_start = time.time()
+    output = subprocess.run(
+        [sys.executable, "-c", COLD_START_SCRIPT],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    imported, first_inference = map(float, output.split()[-2:])
+    return imported - process_start, first_inference - process_start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    serialized_model_path = get_serialized_model_path("radgraph-xl")
+    if not os.path.exists(serialized_model_path):
+        sys.exit(f"{serialized_model_path} does not exist, run setup.py first")
+
+    for name, path in [
+        ("construct RadGraph", "./does-not-exist.pt"),
+        ("memory mapped", serialized_model_path),
+    ]:
+        measurements = [measure_cold_start(path) for _ in range(args.runs)]
+        import_sec = statistics.median(m[0] for m in measurements)
+        first_inference_sec = statistics.median(m[1] for m in measurements)
+        print(
+            f"{name:>18}: import {import_sec:6.2f}s, "
+            f"time to first inference {first_inference_sec:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
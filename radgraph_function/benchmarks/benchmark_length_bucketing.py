@@ -0,0 +1,136 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Compares the throughput of running the same reports through radgraph-xl in batches of
+# arrival order and in length buckets as done by the RadGraph function. Both run every
+# batch as one document, whose entities and relations have to match those of
+# model(reports), which runs every report in its own forward pass.
+#
+# Usage (from the radgraph_function directory):
+#   python -m benchmarks.benchmark_length_bucketing [--corpus <dir with .txt reports>]
+
+import argparse
+import sys
+import time
+
+import torch
+
+from batching import split_into_length_buckets
+from benchmarks.corpus import load_corpus
+from benchmarks.evaluate_precision import get_agreement, get_entities, get_relations
+from inference import annotate_reports
+from main import (
+    BUCKET_OVERHEAD_TOKENS,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_TOKENS,
+    PRECISION,
+    model,
+    tokenizer,
+)
+from precision import precision_context
+
+
+def count_padded_tokens(token_lengths, batches):
+    return sum(
+        len(batch) * max(token_lengths[report_index] for report_index in batch)
+        for batch in batches
+    )
+
+
+def run(reports, batches):
+    annotations = [None] * len(reports)
+    start = time.perf_counter()
+    for batch in batches:
+        batch_annotations = annotate_reports(
+            model, [reports[report_index] for report_index in batch], PRECISION
+        )
+        for report_index, annotation in zip(batch, batch_annotations):
+            annotations[report_index] = annotation
+    return time.perf_counter() - start, annotations
+
+
+def annotate_separately(reports, batch_size):
+    annotations = []
+    with torch.inference_mode(), precision_context(PRECISION):
+        for start in range(0, len(reports), batch_size):
+            batch_annotations = model(reports[start : start + batch_size])
+            annotations.extend(
+                batch_annotations[str(report_index)]
+                for report_index in range(len(batch_annotations))
+            )
+    return annotations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-batch-tokens", type=int, default=MAX_BATCH_TOKENS)
+    parser.add_argument(
+        "--bucket-overhead-tokens", type=int, default=BUCKET_OVERHEAD_TOKENS
+    )
+    args = parser.parse_args()
+
+    reports = load_corpus(args.corpus)
+    token_lengths = [
+        len(input_ids)
+        for input_ids in tokenizer(reports, add_special_tokens=False)["input_ids"]
+    ]
+    total_tokens = sum(token_lengths)
+
+    # Both strategies see the reports in batches of the same size, the bucketed one
+    # additionally splits every batch into buckets of similar length.
+    arrival_batches = [
+        list(range(start, min(start + args.batch_size, len(reports))))
+        for start in range(0, len(reports), args.batch_size)
+    ]
+    bucketed_batches = [
+        [batch[bucket_index] for bucket_index in bucket]
+        for batch in arrival_batches
+        for bucket in split_into_length_buckets(
+            [token_lengths[report_index] for report_index in batch],
+            args.max_batch_tokens,
+            args.bucket_overhead_tokens,
+        )
+    ]
+
+    # Warmup so that neither strategy pays for the lazy initialization
+    annotate_reports(model, reports[: args.batch_size], PRECISION)
+
+    reference_annotations = annotate_separately(reports, args.batch_size)
+
+    print(f"{len(reports)} reports with {total_tokens} tokens")
+    mismatches = []
+    for name, batches in [
+        ("arrival order", arrival_batches),
+        ("length buckets", bucketed_batches),
+    ]:
+        duration, annotations = run(reports, batches)
+        padded_tokens = count_padded_tokens(token_lengths, batches)
+        entity_agreement = get_agreement(
+            reference_annotations, annotations, get_entities
+        )
+        relation_agreement = get_agreement(
+            reference_annotations, annotations, get_relations
+        )
+        print(
+            f"{name:>15}: {len(batches):3d} model calls, "
+            f"{padded_tokens:7d} padded tokens "
+            f"({total_tokens / padded_tokens:6.1%} useful), "
+            f"{total_tokens / duration:8.1f} tokens/sec, "
+            f"entity F1 {entity_agreement:.4f}, relation F1 {relation_agreement:.4f}"
+        )
+        if entity_agreement < 1 or relation_agreement < 1:
+            mismatches.append(name)
+
+    if mismatches:
+        sys.exit(f"Annotations of {', '.join(mismatches)} differ from model(reports)")
+
+
+if __name__ == "__main__":
+    main()
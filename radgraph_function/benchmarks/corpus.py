@@ -0,0 +1,47 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import pathlib
+import random
+
+SHORT_REPORT = "IMPRESSION: No acute cardiopulmonary abnormality."
+LONG_REPORT_SENTENCES = [
+    "The liver is normal in size and attenuation without focal lesion.",
+    "The gallbladder is unremarkable without radiopaque stones.",
+    "The pancreas enhances homogeneously without ductal dilatation.",
+    "The spleen and adrenal glands are unremarkable.",
+    "The kidneys are normal in size without hydronephrosis.",
+    "There is a 4 mm nonobstructing calculus in the lower pole of the left kidney.",
+    "No free fluid or free air in the abdomen or pelvis.",
+    "Mild degenerative changes of the lumbar spine.",
+]
+
+
+# Loads all .txt reports of the given directory or, if no directory is given, a
+# synthetic corpus of short and long reports
+def load_corpus(corpus_dir):
+    if corpus_dir is not None:
+        return [
+            path.read_text() for path in sorted(pathlib.Path(corpus_dir).glob("*.txt"))
+        ]
+
+    # Mix of short chest X-ray impressions and long CT reports
+    rng = random.Random(0)
+    reports = []
+    for _ in range(64):
+        if rng.random() < 0.6:
+            reports.append(SHORT_REPORT)
+        else:
+            sentence_count = rng.randint(8, 40)
+            reports.append(
+                "FINDINGS: "
+                + " ".join(
+                    rng.choice(LONG_REPORT_SENTENCES) for _ in range(sentence_count)
+                )
+            )
+    return reports
@@ -0,0 +1,131 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Compares the annotations and latency of the reduced precision modes against fp32 to
+# decide whether a precision mode can be enabled safely via RADGRAPH_PRECISION.
+#
+# Usage (from the radgraph_function directory):
+#   python -m benchmarks.evaluate_precision [--corpus <dir with .txt reports>]
+
+import argparse
+import io
+import statistics
+import time
+
+import torch
+
+from benchmarks.corpus import load_corpus
+from inference import annotate_reports
+from model_loading import load_model
+from precision import PRECISIONS, apply_precision, resolve_precision
+
+
+def get_model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def annotate_corpus(model, reports, precision):
+    annotate_reports(model, reports[:1], precision)
+
+    annotations = []
+    latencies = []
+    for report in reports:
+        start = time.perf_counter()
+        annotations.append(annotate_reports(model, [report], precision)[0])
+        latencies.append(time.perf_counter() - start)
+    return annotations, latencies
+
+
+def get_entities(annotation):
+    return {
+        (entity["start_ix"], entity["end_ix"], entity["label"])
+        for entity in annotation["entities"].values()
+    }
+
+
+def get_relations(annotation):
+    entities = annotation["entities"]
+    return {
+        (
+            entity["start_ix"],
+            entity["end_ix"],
+            entities[target_entity_id]["start_ix"],
+            entities[target_entity_id]["end_ix"],
+            relation_type,
+        )
+        for entity in entities.values()
+        for relation_type, target_entity_id in entity["relations"]
+    }
+
+
+# F1 of the predictions of a precision mode using the fp32 predictions as reference
+def get_agreement(reference_annotations, annotations, get_items):
+    true_positives = 0
+    reference_count = 0
+    prediction_count = 0
+    for reference_annotation, annotation in zip(reference_annotations, annotations):
+        reference_items = get_items(reference_annotation)
+        items = get_items(annotation)
+        true_positives += len(reference_items & items)
+        reference_count += len(reference_items)
+        prediction_count += len(items)
+    if reference_count + prediction_count == 0:
+        return 1.0
+    return 2 * true_positives / (reference_count + prediction_count)
+
+
+def get_percentile(values, percentile):
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--precisions", nargs="+", default=PRECISIONS)
+    args = parser.parse_args()
+
+    reports = load_corpus(args.corpus)
+
+    results = {}
+    for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+        resolved_precision = resolve_precision(precision)
+        if resolved_precision != precision:
+            continue
+        # Not using the model of main, as it is loaded with the configured precision
+        model = apply_precision(load_model("radgraph-xl"), precision)
+        annotations, latencies = annotate_corpus(model, reports, precision)
+        results[precision] = (annotations, latencies, get_model_size_mb(model))
+        del model
+
+    reference_annotations, reference_latencies, _ = results["fp32"]
+    print(f"{len(reports)} reports")
+    print(
+        f"{'precision':>9} {'entity F1':>9} {'relation F1':>11} "
+        f"{'mean ms':>8} {'p95 ms':>8} {'speedup':>7} {'weights MB':>10}"
+    )
+    for precision, (annotations, latencies, model_size) in results.items():
+        entity_agreement = get_agreement(
+            reference_annotations, annotations, get_entities
+        )
+        relation_agreement = get_agreement(
+            reference_annotations, annotations, get_relations
+        )
+        speedup = statistics.mean(reference_latencies) / statistics.mean(latencies)
+        print(
+            f"{precision:>9} {entity_agreement:9.4f} {relation_agreement:11.4f} "
+            f"{statistics.mean(latencies) * 1000:8.1f} "
+            f"{get_percentile(latencies, 95) * 1000:8.1f} "
+            f"{speedup:6.2f}x "
+            f"{model_size:10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
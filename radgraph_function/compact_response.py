@@ -0,0 +1,70 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import gzip
+import json
+from typing import Any, Dict
+
+import flask
+
+# Requested by callers via the Accept header, the response then only contains the fields
+# the Firebase functions use:
+#   radgraph_text: as in the full response
+#   processed_annotations: as in the full response
+#   entity_spans: start_ix and end_ix of every entity, flattened into one integer array
+#   radgraph_token_offsets: if requested, start and end of every token flattened into
+#     one integer array, -1 for tokens without offsets
+# The /batch route returns the same fields for every successfully annotated report.
+COMPACT_MIMETYPE = "application/vnd.radgraph.compact+json"
+# Smaller responses do not gain enough from compression to be worth the time
+GZIP_MIN_BYTES = 1024
+
+
+def accepts_compact_response(request: flask.Request) -> bool:
+    return COMPACT_MIMETYPE in request.accept_mimetypes.values()
+
+
+def to_compact_response(processed_annotations: Dict[str, Any]) -> Dict[str, Any]:
+    entities = processed_annotations["radgraph_annotations"]["0"]["entities"]
+    compact_response = {
+        "radgraph_text": processed_annotations["radgraph_text"],
+        "processed_annotations": processed_annotations["processed_annotations"],
+        "entity_spans": [
+            ix
+            for entity in entities.values()
+            for ix in (entity["start_ix"], entity["end_ix"])
+        ],
+    }
+    if "radgraph_token_offsets" in processed_annotations:
+        compact_response["radgraph_token_offsets"] = [
+            ix
+            for token_offset in processed_annotations["radgraph_token_offsets"]
+            for ix in (token_offset if token_offset is not None else (-1, -1))
+        ]
+    return compact_response
+
+
+# Serializes without whitespace and compresses with gzip if the caller accepts it. The
+# lowest compression level already removes most of the redundancy of the JSON.
+def make_compact_json_response(
+    request: flask.Request, body: Dict[str, Any]
+) -> flask.Response:
+    data = json.dumps(body, separators=(",", ":")).encode()
+    headers = {"Content-Type": COMPACT_MIMETYPE, "Vary": "Accept, Accept-Encoding"}
+    if len(data) >= GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        data = gzip.compress(data, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    return flask.Response(data, headers=headers)
+
+
+def make_compact_response(
+    request: flask.Request, processed_annotations: Dict[str, Any]
+) -> flask.Response:
+    return make_compact_json_response(
+        request, to_compact_response(processed_annotations)
+    )
@@ -6,6 +6,9 @@
 # SPDX-License-Identifier: MIT
 #
 
+# The warmup only pays off if a startup or readiness probe on /ready starts it before
+# traffic arrives. The deployed function has no such probe, so the first request of every
+# instance would start the warmup and wait for it, hence it is disabled here.
 gcloud functions deploy radgraph-http-function \
     --runtime=python310 \
     --region=us-central1 \
@@ -16,4 +19,5 @@ gcloud functions deploy radgraph-http-function \
     --concurrency 80 \
     --max-instances 5 \
     --min-instances 0 \
+    --set-env-vars RADGRAPH_WARMUP=0 \
     --no-allow-unauthenticated
\ No newline at end of file
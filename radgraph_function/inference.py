@@ -0,0 +1,157 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import contextlib
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from radgraph import RadGraph
+from radgraph.allennlp.data.dataloader import PyTorchDataLoader
+from radgraph.allennlp.data.dataset_readers import AllennlpDataset
+from radgraph.utils import batch_to_device, get_entity, preprocess_reports
+
+from metrics import inference_seconds, model_input_seconds, sentence_splitting_seconds
+from precision import precision_context
+
+
+# Raised from within the forward pass once the should_abort function passed to
+# annotate_reports returns True
+class InferenceAbortedError(Exception):
+    pass
+
+
+__abort_state = threading.local()
+
+
+def __raise_if_aborted(module, inputs):
+    should_abort = getattr(__abort_state, "should_abort", None)
+    if should_abort is not None and should_abort():
+        raise InferenceAbortedError()
+
+
+# Checks for an abort before every top-level module of DyGIE and every transformer layer,
+# so that an aborted forward pass stops within a fraction of its duration
+def register_abort_hooks(model: RadGraph) -> None:
+    for module in model.model.modules():
+        if isinstance(module, torch.nn.ModuleList):
+            for layer in module:
+                layer.register_forward_pre_hook(__raise_if_aborted)
+    for module in model.model.children():
+        module.register_forward_pre_hook(__raise_if_aborted)
+
+
+@contextlib.contextmanager
+def __abort_when(should_abort: Optional[Callable[[], bool]]):
+    __abort_state.should_abort = should_abort
+    try:
+        yield
+    finally:
+        __abort_state.should_abort = None
+
+
+# RadGraph.forward runs every report in its own forward pass as DyGIE does not support
+# batching multiple documents. DyGIE does however encode all sentences of a document as
+# one padded batch and predicts entities and relations per sentence. Passing the reports
+# as sentences of a single document is therefore equivalent, as long as the model does
+# not propagate information across sentences through coreference.
+def supports_document_batching(model: RadGraph) -> bool:
+    dygie = model.model
+    return dygie._loss_weights["coref"] == 0 and dygie._coref.coref_prop == 0
+
+
+def __annotate_as_document(
+    model: RadGraph,
+    tokenized_reports: List[List[str]],
+    should_abort: Optional[Callable[[], bool]],
+) -> List[Dict[str, Any]]:
+    # Includes the wordpiece tokenization and indexing of the reports
+    with model_input_seconds.time():
+        instance = model.reader.text_to_instance(
+            {
+                "doc_key": "0",
+                "sentences": tokenized_reports,
+                "dataset": model.model_type,
+            }
+        )
+        data = AllennlpDataset([instance])
+        data.index_with(model.model.vocab)
+        batch = next(iter(PyTorchDataLoader(batch_size=1, dataset=data)))
+
+    with inference_seconds.time(), __abort_when(should_abort):
+        output_dict = model.model(**batch_to_device(batch, model.device))
+    document = model.model.make_output_human_readable(output_dict).to_json()
+
+    # DyGIE predicts spans with document-level token indices while the RadGraph
+    # annotations refer to the tokens of the individual report
+    annotations = []
+    sentence_start = 0
+    for tokens, entities, relations in zip(
+        document["sentences"],
+        document["predicted_ner"],
+        document["predicted_relations"],
+    ):
+        entities = [
+            [start - sentence_start, end - sentence_start, *prediction]
+            for start, end, *prediction in entities
+        ]
+        relations = [
+            [
+                start - sentence_start,
+                end - sentence_start,
+                object_start - sentence_start,
+                object_end - sentence_start,
+                *prediction,
+            ]
+            for start, end, object_start, object_end, *prediction in relations
+        ]
+        annotations.append(
+            {
+                "text": " ".join(tokens),
+                "entities": get_entity(entities, relations, tokens),
+                "data_source": None,
+                "data_split": "inference",
+            }
+        )
+        sentence_start += len(tokens)
+    return annotations
+
+
+# Returns the raw RadGraph annotation of every report in the order of the given reports.
+# The forward pass is aborted if should_abort returns True and the model has been passed
+# to register_abort_hooks.
+def annotate_reports(
+    model: RadGraph,
+    reports: List[str],
+    precision: str = "fp32",
+    should_abort: Optional[Callable[[], bool]] = None,
+) -> List[Dict[str, Any]]:
+    if should_abort is not None and should_abort():
+        raise InferenceAbortedError()
+
+    with torch.inference_mode(), precision_context(precision):
+        with sentence_splitting_seconds.time():
+            tokenized_reports = [
+                model_input["sentences"][0]
+                for model_input in preprocess_reports(
+                    ["None" if not report else report for report in reports],
+                    model.model_type,
+                )
+            ]
+        # Single-token sentences break DyGIE when batched with other sentences
+        if (
+            len(reports) > 1
+            and supports_document_batching(model)
+            and min(len(tokens) for tokens in tokenized_reports) > 1
+        ):
+            return __annotate_as_document(model, tokenized_reports, should_abort)
+
+        # Includes the tokenization of RadGraph.forward, which is small in comparison
+        with inference_seconds.time(), __abort_when(should_abort):
+            annotations = model(reports)
+        return [annotations[str(report_index)] for report_index in range(len(reports))]
@@ -6,27 +6,495 @@
 # SPDX-License-Identifier: MIT
 #
 
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import flask
 import functions_framework
+import torch
+
+from radgraph import get_radgraph_processed_annotations
+from transformers import AutoTokenizer
+
+from annotation_cache import AnnotationCache
+from batching import DeadlineExceededError, MicroBatcher, split_into_length_buckets
+from compact_response import (
+    accepts_compact_response,
+    make_compact_json_response,
+    make_compact_response,
+    to_compact_response,
+)
+from inference import InferenceAbortedError, annotate_reports, register_abort_hooks
+from metrics import (
+    batch_size,
+    expired_requests,
+    postprocess_seconds,
+    queue_wait_seconds,
+    registry,
+    rejected_requests_deadline,
+    rejected_requests_queue_full,
+    report_tokens,
+    request_seconds,
+    token_counting_seconds,
+)
+from model_loading import load_model
+from precision import apply_precision, resolve_precision
+from report_stitching import merge_annotations, pack_into_chunks, split_into_sentences
+from text_offsets import add_text_offsets
+
+# Larger batches and longer windows increase throughput under load at the cost of
+# latency for the individual request. A batch size of 1 disables batching.
+MAX_BATCH_SIZE = int(os.environ.get("RADGRAPH_MAX_BATCH_SIZE", 8))
+BATCH_WINDOW_MS = float(os.environ.get("RADGRAPH_BATCH_WINDOW_MS", 10))
+# Batches are split into buckets of similarly long reports. MAX_BATCH_TOKENS bounds the
+# padded size (number of reports x longest report in tokens) of a single model call and
+# BUCKET_OVERHEAD_TOKENS is the cost of an additional model call expressed in tokens.
+MAX_BATCH_TOKENS = int(os.environ.get("RADGRAPH_MAX_BATCH_TOKENS", 4096))
+BUCKET_OVERHEAD_TOKENS = int(os.environ.get("RADGRAPH_BUCKET_OVERHEAD_TOKENS", 128))
+# Number of buckets of a batch that are run through the model concurrently
+INFERENCE_WORKERS = int(os.environ.get("RADGRAPH_INFERENCE_WORKERS", 1))
+
+# Reports that are not cached are rejected with 503 instead of queued once the queue of
+# the micro-batcher holds MAX_QUEUE_DEPTH reports (0 disables the limit), and with 429
+# once the estimated time until their result exceeds the deadline sent by the caller in
+# the DEADLINE_HEADER header (seconds remaining). Both carry a Retry-After estimate.
+# Queued reports are dropped once their deadline passed and a running batch is aborted
+# once the deadlines of all its reports passed, both are answered with 504.
+MAX_QUEUE_DEPTH = int(os.environ.get("RADGRAPH_MAX_QUEUE_DEPTH", 0))
+DEADLINE_HEADER = "X-Request-Deadline-Sec"
+
+# Maximum number of reports of a request to the /batch route. The reports of a batch
+# request are annotated by up to BATCH_REQUEST_WORKERS threads.
+MAX_BATCH_REQUEST_REPORTS = int(
+    os.environ.get("RADGRAPH_MAX_BATCH_REQUEST_REPORTS", 64)
+)
+BATCH_REQUEST_WORKERS = int(os.environ.get("RADGRAPH_BATCH_REQUEST_WORKERS", 16))
+# Callers that accept newline-delimited JSON receive the result of every report of a
+# /batch request as soon as it is annotated, in the order of completion. Every line
+# carries the index of its report. The results are compact if the caller also accepts
+# the compact response, which the parameter of the content type signals.
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Reports longer than LONG_REPORT_TOKENS are split into chunks of sentences of at most
+# CHUNK_TOKENS tokens that are annotated together in one batch and merged afterwards.
+# This keeps long reports within the maximum sequence length of the model.
+LONG_REPORT_TOKENS = int(os.environ.get("RADGRAPH_LONG_REPORT_TOKENS", 384))
+CHUNK_TOKENS = int(os.environ.get("RADGRAPH_CHUNK_TOKENS", 256))
+
+# Tokenizer used by radgraph-xl, it is downloaded next to the model by RadGraph(...)
+TOKENIZER_NAME = "microsoft/BiomedVLP-CXR-BERT-general"
+
+# Processed annotations are cached by report in memory and, if a directory is given,
+# on disk. A cache size of 0 disables the in-memory tier.
+CACHE_SIZE = int(os.environ.get("RADGRAPH_CACHE_SIZE", 1024))
+CACHE_DIR = os.environ.get("RADGRAPH_CACHE_DIR")
+# Annotates reports sentence by sentence and caches the annotations of every sentence,
+# so that only unseen sentences are run through the model. Relations across sentence
+# boundaries are not detected in this mode.
+SENTENCE_CACHE = os.environ.get("RADGRAPH_SENTENCE_CACHE", "0") == "1"
+SENTENCE_CACHE_SIZE = int(os.environ.get("RADGRAPH_SENTENCE_CACHE_SIZE", 65536))
+
+MODEL_TYPE = "radgraph-xl"
+# One of fp32, int8 (dynamic quantization of the linear layers) or bf16 (autocast on
+# CPUs with native bf16 support). Use benchmarks/evaluate_precision.py to compare the
+# annotations against fp32 before switching.
+PRECISION = resolve_precision(os.environ.get("RADGRAPH_PRECISION", "fp32"))
+
+# Threads used within a single operator and across independent operators. By default,
+# torch uses one intra-op thread per core, which oversubscribes the cores if multiple
+# buckets are run concurrently (INFERENCE_WORKERS). 0 keeps the torch default.
+TORCH_THREADS = int(os.environ.get("RADGRAPH_TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.environ.get("RADGRAPH_TORCH_INTEROP_THREADS", 0))
+# Runs a synthetic inference in the background, so that the first real request does not
+# pay for the lazy initialization of kernels, thread pools and the tokenizer. The warmup
+# starts with the first request of a process, e.g. the /ready probe, or when serve.py
+# forks a worker. It never runs in a process that forks afterwards, as the forked
+# workers would neither inherit its thread nor be able to acquire the locks it holds.
+# Requests wait up to WARMUP_WAIT_SEC or their deadline for the warmup and are rejected
+# with 503 after. Without a startup or readiness probe on /ready, the first request
+# starts the warmup and waits for it, which is why deploy.sh disables it.
+WARMUP = os.environ.get("RADGRAPH_WARMUP", "1") == "1"
+WARMUP_WAIT_SEC = float(os.environ.get("RADGRAPH_WARMUP_WAIT_SEC", 60))
+WARMUP_RETRY_AFTER_SEC = 5
+
+# The number of inter-op threads can only be set before any inter-op work has started
+if TORCH_INTEROP_THREADS > 0:
+    torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
+
+model = apply_precision(load_model(MODEL_TYPE), PRECISION)
+register_abort_hooks(model)
+tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, cache_dir="./")
+
+
+def __count_tokens(reports):
+    with token_counting_seconds.time():
+        input_ids = tokenizer(reports, add_special_tokens=False)["input_ids"]
+    return [len(report_input_ids) for report_input_ids in input_ids]
+
 
-from radgraph import RadGraph, get_radgraph_processed_annotations
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_REQUEST_WORKERS)
+inference_executor = (
+    ThreadPoolExecutor(max_workers=INFERENCE_WORKERS) if INFERENCE_WORKERS > 1 else None
+)
+
+
+# Returns the raw annotation of every report in the order of the given reports
+def __annotate_reports(reports, should_abort=None):
+    buckets = split_into_length_buckets(
+        __count_tokens(reports), MAX_BATCH_TOKENS, BUCKET_OVERHEAD_TOKENS
+    )
+    bucket_reports = [
+        [reports[report_index] for report_index in bucket] for bucket in buckets
+    ]
+    annotate_bucket = functools.partial(
+        annotate_reports, model, precision=PRECISION, should_abort=should_abort
+    )
+    if inference_executor is not None:
+        bucket_annotations = inference_executor.map(annotate_bucket, bucket_reports)
+    else:
+        bucket_annotations = map(annotate_bucket, bucket_reports)
+
+    results = [None] * len(reports)
+    for bucket, annotations in zip(buckets, bucket_annotations):
+        for report_index, annotation in zip(bucket, annotations):
+            results[report_index] = annotation
+    return results
 
-model = RadGraph(
-    model_type="radgraph-xl",
-    model_cache_dir="./",
-    tokenizer_cache_dir="./",
+
+batcher = MicroBatcher(
+    __annotate_reports,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_sec=BATCH_WINDOW_MS / 1000,
+    queue_wait_histogram=queue_wait_seconds,
+    batch_size_histogram=batch_size,
+)
+
+# The annotations of a report also depend on whether it is annotated sentence by
+# sentence or, if it is long, in chunks, hence the report cache is kept apart by mode
+ANNOTATION_MODE = (
+    "sentences" if SENTENCE_CACHE else f"chunks-{LONG_REPORT_TOKENS}-{CHUNK_TOKENS}"
+)
+cache = AnnotationCache(
+    f"{MODEL_TYPE}/{PRECISION}/{ANNOTATION_MODE}",
+    max_entries=CACHE_SIZE,
+    disk_dir=CACHE_DIR,
+)
+sentence_cache = AnnotationCache(
+    f"{MODEL_TYPE}/{PRECISION}/sentence",
+    max_entries=SENTENCE_CACHE_SIZE,
+    disk_dir=CACHE_DIR,
 )
 
+registry.callback(
+    "radgraph_queue_depth",
+    "Number of reports waiting in the micro-batcher",
+    "gauge",
+    batcher.queue_depth,
+)
+
+
+def __register_cache_metrics(cache_name, annotation_cache):
+    labels = {"cache": cache_name}
+    for stat in ["memory_hits", "disk_hits", "misses"]:
+        registry.callback(
+            f"radgraph_cache_{stat}_total",
+            f"Number of cache {stat.replace('_', ' ')}",
+            "counter",
+            functools.partial(lambda stat: annotation_cache.stats()[stat], stat),
+            labels,
+        )
+    registry.callback(
+        "radgraph_cache_entries",
+        "Number of entries in the in-memory cache",
+        "gauge",
+        lambda: annotation_cache.stats()["entries"],
+        labels,
+    )
+
+
+__register_cache_metrics("report", cache)
+__register_cache_metrics("sentence", sentence_cache)
+
+
+def __annotate_by_sentences(report, deadline):
+    sentences = split_into_sentences(report)
+    if not sentences:
+        return batcher(report, deadline)
+
+    annotations = {sentence: sentence_cache.get(sentence) for sentence in sentences}
+    futures = {
+        sentence: batcher.submit(sentence, deadline)
+        for sentence, annotation in annotations.items()
+        if annotation is None
+    }
+    for sentence, future in futures.items():
+        annotations[sentence] = future.result()
+        sentence_cache.put(sentence, annotations[sentence])
+
+    return merge_annotations([annotations[sentence] for sentence in sentences])
+
+
+def __annotate_in_chunks(report, deadline):
+    sentences = split_into_sentences(report)
+    chunks = pack_into_chunks(sentences, __count_tokens(sentences), CHUNK_TOKENS)
+    futures = [batcher.submit(chunk, deadline) for chunk in chunks]
+    return merge_annotations([future.result() for future in futures])
+
+
+# The radgraph post-processing only looks at the annotation with the key "0", hence
+# the report is handed over as a single-report annotation.
+def __get_processed_annotations(report, deadline):
+    token_count = __count_tokens([report])[0]
+    report_tokens.observe(token_count)
+
+    if SENTENCE_CACHE:
+        annotation = __annotate_by_sentences(report, deadline)
+    elif token_count > LONG_REPORT_TOKENS:
+        annotation = __annotate_in_chunks(report, deadline)
+    else:
+        annotation = batcher(report, deadline)
+
+    with postprocess_seconds.time():
+        return get_radgraph_processed_annotations({"0": annotation})
+
+
+def __get_overload_response(deadline_sec):
+    estimated_wait_sec = batcher.estimate_wait_sec()
+    headers = {"Retry-After": str(math.ceil(estimated_wait_sec or 1))}
+
+    if MAX_QUEUE_DEPTH > 0 and batcher.queue_depth() >= MAX_QUEUE_DEPTH:
+        rejected_requests_queue_full.inc()
+        return "RadGraph queue is full", 503, headers
+
+    if (
+        deadline_sec is not None
+        and estimated_wait_sec is not None
+        and estimated_wait_sec > deadline_sec
+    ):
+        rejected_requests_deadline.inc()
+        return "RadGraph cannot annotate the report before the deadline", 429, headers
+    return None
+
+
+# A short and a long report, so that both the single report and the batched code path
+# of annotate_reports are initialized
+WARMUP_REPORTS = [
+    "No acute cardiopulmonary process.",
+    "FINDINGS: The lungs are clear without focal consolidation, pleural effusion or "
+    "pneumothorax. The cardiomediastinal silhouette is within normal limits. "
+    "IMPRESSION: No acute cardiopulmonary abnormality.",
+]
+
+warmup_finished = threading.Event()
+warmup_error = None
+__warmup_started = False
+__warmup_lock = threading.Lock()
+if not WARMUP:
+    warmup_finished.set()
+
+
+# Bypasses the caches, so that the synthetic reports neither show up in the cache
+# statistics nor are returned to callers
+def warmup():
+    global warmup_error
+    try:
+        __annotate_reports(WARMUP_REPORTS[:1])
+        for annotation in __annotate_reports(WARMUP_REPORTS):
+            get_radgraph_processed_annotations({"0": annotation})
+    except Exception as error:
+        warmup_error = error
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        warmup_finished.set()
+
+
+# Starts the warmup once per process, unless it is disabled
+def start_warmup():
+    global __warmup_started
+    with __warmup_lock:
+        if __warmup_started or warmup_finished.is_set():
+            return
+        __warmup_started = True
+    threading.Thread(target=warmup, name="radgraph-warmup", daemon=True).start()
+
+
+# Returns the processed annotations of the report or an error response consisting of
+# the message, the status code and the headers
+def __annotate_report(report, deadline, deadline_sec, include_offsets):
+    with request_seconds.time():
+        processed_annotations = cache.get(report)
+        if processed_annotations is None:
+            overload_response = __get_overload_response(deadline_sec)
+            if overload_response is not None:
+                return overload_response
+            try:
+                processed_annotations = __get_processed_annotations(report, deadline)
+            except (DeadlineExceededError, InferenceAbortedError):
+                expired_requests.inc()
+                return (
+                    "RadGraph did not annotate the report before the deadline",
+                    504,
+                    {},
+                )
+            # Also keeps the other reports of a batch request from failing with it
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                return "RadGraph failed to annotate the report", 500, {}
+            cache.put(report, processed_annotations)
+
+    # Opt-in, as the offsets refer to the exact report while the cache entries are
+    # shared by reports that only differ in whitespace
+    if include_offsets:
+        processed_annotations = add_text_offsets(report, processed_annotations)
+    return processed_annotations
+
+
+# Converts the processed annotations or the error response returned by
+# __annotate_report into an item of the results of a /batch request
+def __to_batch_result(result, compact):
+    if isinstance(result, tuple):
+        message, status_code, headers = result
+        error = {"status": status_code, "error": message}
+        if "Retry-After" in headers:
+            error["retry_after"] = int(headers["Retry-After"])
+        return error
+    return {
+        "status": 200,
+        "result": to_compact_response(result) if compact else result,
+    }
+
+
+# Any error of a report becomes its item instead of failing the whole batch. Once a
+# streamed response has started, it would otherwise be cut off without an error.
+def __get_batch_result(future, compact):
+    try:
+        return __to_batch_result(future.result(), compact)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        return {"status": 500, "error": "RadGraph failed to annotate the report"}
+
+
+# Annotates the reports concurrently, so that they are combined by the micro-batcher like
+# reports of concurrent requests. Every report gets its own result or error.
+def __annotate_report_batch(request, reports, deadline, deadline_sec, include_offsets):
+    compact = accepts_compact_response(request)
+    futures = [
+        batch_executor.submit(
+            __annotate_report, report, deadline, deadline_sec, include_offsets
+        )
+        for report in reports
+    ]
+    results = [__get_batch_result(future, compact) for future in futures]
+
+    if compact:
+        return make_compact_json_response(request, {"results": results})
+    return {"results": results}
+
+
+# The reports are submitted before the response is returned, the response then yields
+# their results while they complete
+def __stream_report_batch(request, reports, deadline, deadline_sec, include_offsets):
+    compact = accepts_compact_response(request)
+    report_indices = {
+        batch_executor.submit(
+            __annotate_report, report, deadline, deadline_sec, include_offsets
+        ): report_index
+        for report_index, report in enumerate(reports)
+    }
+
+    def stream_results():
+        for future in as_completed(report_indices):
+            result = {
+                "index": report_indices[future],
+                **__get_batch_result(future, compact),
+            }
+            yield json.dumps(result, separators=(",", ":")) + "\n"
+
+    content_type = (
+        f"{NDJSON_MIMETYPE}; radgraph=compact" if compact else NDJSON_MIMETYPE
+    )
+    return flask.Response(stream_results(), headers={"Content-Type": content_type})
+
 
 @functions_framework.http
 def get_radgraph(request):
+    if request.path == "/stats":
+        return {"cache": cache.stats(), "sentence_cache": sentence_cache.stats()}
+    if request.path == "/metrics":
+        return (
+            registry.render(),
+            200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+    start_warmup()
+    # Readiness probe for load balancers, which should not route requests to an
+    # instance before its model is warm
+    if request.path == "/ready":
+        if not warmup_finished.is_set():
+            return "Warming up", 503
+        if warmup_error is not None:
+            return "Warmup failed", 503
+        return "Ready", 200
+
     request_json = request.get_json(silent=True)
     request_args = request.args
+    include_offsets = bool(request_json and request_json.get("include_offsets"))
 
-    if request_json and "report" in request_json:
+    if request.path == "/batch":
+        if not request_json or not isinstance(request_json.get("reports"), list):
+            return "Missing reports for radgraph", 400
+        reports = request_json["reports"]
+        if len(reports) > MAX_BATCH_REQUEST_REPORTS:
+            return f"At most {MAX_BATCH_REQUEST_REPORTS} reports per batch", 400
+        if not all(isinstance(report, str) for report in reports):
+            return "Reports for radgraph must be strings", 400
+    elif request_json and "report" in request_json:
         report = request_json["report"]
     elif request_args and "name" in request_args:
         report = request_args["report"]
     else:
         return "Missing report for radgraph", 400
-    annotations = model([report])
-    return get_radgraph_processed_annotations(annotations)
+
+    # Converted to an absolute deadline of this process on arrival, as the clocks of the
+    # caller and the function are not synchronized
+    deadline_sec = request.headers.get(DEADLINE_HEADER, type=float)
+    deadline = time.monotonic() + deadline_sec if deadline_sec is not None else None
+
+    # Requests that arrive before the warmup finished wait instead of running on a cold
+    # model concurrently to the warmup, but neither past their deadline nor forever if
+    # the warmup hangs
+    if not warmup_finished.is_set():
+        warmup_wait_sec = WARMUP_WAIT_SEC
+        if deadline_sec is not None:
+            warmup_wait_sec = min(warmup_wait_sec, deadline_sec)
+        if not warmup_finished.wait(warmup_wait_sec):
+            return "Warming up", 503, {"Retry-After": str(WARMUP_RETRY_AFTER_SEC)}
+        if deadline is not None:
+            deadline_sec = deadline - time.monotonic()
+
+    if request.path == "/batch":
+        if NDJSON_MIMETYPE in request.accept_mimetypes.values():
+            return __stream_report_batch(
+                request, reports, deadline, deadline_sec, include_offsets
+            )
+        return __annotate_report_batch(
+            request, reports, deadline, deadline_sec, include_offsets
+        )
+
+    processed_annotations = __annotate_report(
+        report, deadline, deadline_sec, include_offsets
+    )
+    if isinstance(processed_annotations, tuple):
+        return processed_annotations
+    if accepts_compact_response(request):
+        return make_compact_response(request, processed_annotations)
+    return processed_annotations
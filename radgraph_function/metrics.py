@@ -0,0 +1,250 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+LATENCY_BUCKETS_SEC = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+]
+REPORT_TOKEN_BUCKETS = [16, 32, 64, 128, 256, 384, 512, 768, 1024, 2048]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Histogram with fixed buckets in the Prometheus text format. Observing a value costs a
+# binary search and a lock, which is negligible compared to a model call.
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float],
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.labels = labels or {}
+
+        self._lock = threading.Lock()
+        self._bucket_counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._bucket_counts[bucket_index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            value_sum = self._sum
+            count = self._count
+
+        lines = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(
+            self.buckets + [float("inf")], bucket_counts
+        ):
+            cumulative_count += bucket_count
+            labels = format_labels({**self.labels, "le": format_value(upper_bound)})
+            lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+        labels = format_labels(self.labels)
+        lines.append(f"{self.name}_sum{labels} {format_value(value_sum)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            value = self._value
+        return [f"{self.name}{format_labels(self.labels)} {format_value(value)}"]
+
+
+# Counter or gauge whose value is read when the metrics are rendered, e.g. from the
+# statistics the caches keep anyway
+class CallbackMetric:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        get_value: Callable[[], float],
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.get_value = get_value
+        self.labels = labels or {}
+
+    def samples(self) -> List[str]:
+        labels = format_labels(self.labels)
+        return [f"{self.name}{labels} {format_value(self.get_value())}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets, labels=None) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def counter(self, name, help, labels=None) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def callback(self, name, help, type, get_value, labels=None) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, type, get_value, labels))
+
+    # Metrics that share a name but differ in their labels are rendered as one family
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+
+        families: Dict[str, list] = {}
+        for metric in metrics:
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family[0].help}")
+            lines.append(f"# TYPE {name} {family[0].type}")
+            for metric in family:
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+queue_wait_seconds = registry.histogram(
+    "radgraph_queue_wait_seconds",
+    "Time a report waited in the micro-batcher before its batch started",
+    LATENCY_BUCKETS_SEC,
+)
+# Tokenization is labeled by stage, as the stages run at different points of a request:
+# counting the wordpiece tokens of reports to bucket or chunk them, splitting reports into
+# sentences and words before the inference, and building the model input from the words
+token_counting_seconds = registry.histogram(
+    "radgraph_tokenization_seconds",
+    "Time spent tokenizing reports per call, by stage",
+    LATENCY_BUCKETS_SEC,
+    {"stage": "token_counting"},
+)
+sentence_splitting_seconds = registry.histogram(
+    "radgraph_tokenization_seconds",
+    "Time spent tokenizing reports per call, by stage",
+    LATENCY_BUCKETS_SEC,
+    {"stage": "sentence_splitting"},
+)
+model_input_seconds = registry.histogram(
+    "radgraph_tokenization_seconds",
+    "Time spent tokenizing reports per call, by stage",
+    LATENCY_BUCKETS_SEC,
+    {"stage": "model_input"},
+)
+inference_seconds = registry.histogram(
+    "radgraph_inference_seconds",
+    "Time of a forward pass of the model over one length bucket",
+    LATENCY_BUCKETS_SEC,
+)
+postprocess_seconds = registry.histogram(
+    "radgraph_postprocess_seconds",
+    "Time of get_radgraph_processed_annotations per report",
+    LATENCY_BUCKETS_SEC,
+)
+request_seconds = registry.histogram(
+    "radgraph_request_seconds",
+    "End-to-end time of annotation requests, including cache hits",
+    LATENCY_BUCKETS_SEC,
+)
+report_tokens = registry.histogram(
+    "radgraph_report_tokens",
+    "Length of the annotated reports in tokens",
+    REPORT_TOKEN_BUCKETS,
+)
+batch_size = registry.histogram(
+    "radgraph_batch_size",
+    "Number of reports per micro-batch",
+    BATCH_SIZE_BUCKETS,
+)
+rejected_requests_queue_full = registry.counter(
+    "radgraph_rejected_requests_total",
+    "Requests rejected by the admission control",
+    {"reason": "queue_full"},
+)
+rejected_requests_deadline = registry.counter(
+    "radgraph_rejected_requests_total",
+    "Requests rejected by the admission control",
+    {"reason": "deadline"},
+)
+expired_requests = registry.counter(
+    "radgraph_expired_requests_total",
+    "Requests dropped from the queue or aborted during inference after their deadline",
+)
@@ -0,0 +1,37 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import os
+
+import torch
+from radgraph import RadGraph
+
+
+def get_serialized_model_path(model_type: str) -> str:
+    return os.environ.get("RADGRAPH_SERIALIZED_MODEL", f"./{model_type}.pt")
+
+
+# Constructing RadGraph extracts the model archive, builds the model and copies the
+# weights into it, which takes several seconds on every cold start. Hence, setup.py
+# stores the initialized model once at build time.
+def save_model(model: RadGraph, path: str) -> None:
+    torch.save(model, path)
+
+
+# Loads the model stored by setup.py with memory mapped weights, so that the weights are
+# only read from disk when they are first used and are shared with the page cache. Falls
+# back to constructing the model if it has not been stored.
+def load_model(model_type: str) -> RadGraph:
+    serialized_model_path = get_serialized_model_path(model_type)
+    if os.path.exists(serialized_model_path):
+        return torch.load(serialized_model_path, mmap=True, weights_only=False)
+    return RadGraph(
+        model_type=model_type,
+        model_cache_dir="./",
+        tokenizer_cache_dir="./",
+    )
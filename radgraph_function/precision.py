@@ -0,0 +1,50 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import contextlib
+import sys
+
+import torch
+from radgraph import RadGraph
+
+# fp32: full precision as trained
+# int8: dynamic int8 quantization of all linear layers, reduces memory and latency
+# bf16: bfloat16 autocast of the forward pass on CPUs with native bf16 support
+PRECISIONS = ["fp32", "int8", "bf16"]
+
+
+def is_bf16_supported() -> bool:
+    return (
+        torch.backends.mkldnn.is_available()
+        and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    )
+
+
+# Falls back to fp32 if bf16 is requested on a CPU without native bf16 support, as the
+# emulated bf16 kernels are slower than fp32
+def resolve_precision(precision: str) -> str:
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if precision == "bf16" and not is_bf16_supported():
+        print("bf16 is not supported by this CPU, using fp32", file=sys.stderr)
+        return "fp32"
+    return precision
+
+
+def apply_precision(model: RadGraph, precision: str) -> RadGraph:
+    if precision == "int8":
+        torch.ao.quantization.quantize_dynamic(
+            model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
+
+
+def precision_context(precision: str):
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -0,0 +1,79 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import re
+from typing import Any, Dict, List
+
+# Sentences end with a terminal punctuation followed by whitespace. Paragraphs and
+# section headers on their own line (e.g. "FINDINGS:") are split as well. Line breaks
+# within a sentence are kept as reports are often wrapped at a fixed width.
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?])\s+|\n\s*\n|(?<=:)[ \t]*\n\s*")
+
+
+def split_into_sentences(report: str) -> List[str]:
+    return [
+        sentence.strip()
+        for sentence in SENTENCE_BOUNDARY_PATTERN.split(report)
+        if sentence.strip()
+    ]
+
+
+# Packs consecutive sentences into chunks of at most max_chunk_tokens tokens. Section
+# headers (sentences ending with a colon) always start a new chunk, so that sections are
+# kept together where possible. Sentences exceeding the limit form a chunk on their own.
+def pack_into_chunks(
+    sentences: List[str], token_lengths: List[int], max_chunk_tokens: int
+) -> List[str]:
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for sentence, token_length in zip(sentences, token_lengths):
+        is_section_header = sentence.endswith(":")
+        if chunk and (
+            is_section_header or chunk_tokens + token_length > max_chunk_tokens
+        ):
+            chunks.append(" ".join(chunk))
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(sentence)
+        chunk_tokens += token_length
+    if chunk:
+        chunks.append(" ".join(chunk))
+    return chunks
+
+
+# Merges the raw RadGraph annotations of consecutive parts of a report into the
+# annotation of the whole report. Token indices are shifted by the number of tokens of
+# the preceding parts and entity ids are renumbered, including relation targets.
+def merge_annotations(annotations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    texts = []
+    entities = {}
+    token_offset = 0
+    for annotation in annotations:
+        entity_ids = {
+            entity_id: str(len(entities) + entity_index + 1)
+            for entity_index, entity_id in enumerate(annotation["entities"])
+        }
+        for entity_id, entity in annotation["entities"].items():
+            entities[entity_ids[entity_id]] = {
+                **entity,
+                "start_ix": entity["start_ix"] + token_offset,
+                "end_ix": entity["end_ix"] + token_offset,
+                "relations": [
+                    [relation_type, entity_ids[target_entity_id]]
+                    for relation_type, target_entity_id in entity["relations"]
+                ],
+            }
+        texts.append(annotation["text"])
+        token_offset += len(annotation["text"].split(" "))
+
+    return {
+        **(annotations[0] if annotations else {}),
+        "text": " ".join(texts),
+        "entities": entities,
+    }
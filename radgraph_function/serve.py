@@ -0,0 +1,83 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+# Serves get_radgraph with multiple worker processes for self-hosted deployments. The
+# model is loaded once before the workers are forked, hence all workers share the
+# read-only weights copy-on-write instead of each loading their own copy.
+#
+# Usage (from the radgraph_function directory):
+#   python serve.py
+
+import gc
+import os
+import pathlib
+import sys
+
+import functions_framework
+import gunicorn.app.base
+import torch
+
+PORT = int(os.environ.get("PORT", 5002))
+WORKERS = int(os.environ.get("RADGRAPH_WORKERS", 2))
+# Workers x torch threads per worker should match the number of cores
+TORCH_THREADS_PER_WORKER = int(
+    os.environ.get(
+        "RADGRAPH_TORCH_THREADS_PER_WORKER", max(1, (os.cpu_count() or 1) // WORKERS)
+    )
+)
+# Concurrent requests per worker, which are combined by the micro-batcher
+HTTP_THREADS_PER_WORKER = int(os.environ.get("RADGRAPH_HTTP_THREADS_PER_WORKER", 16))
+
+
+class PreforkApplication(gunicorn.app.base.BaseApplication):
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+
+# Every worker starts its warmup right after it is forked instead of with its first
+# request, as the thread pools initialized by a warmup of the parent process would not
+# survive the fork. The worker's /ready route reports when it is done.
+def post_fork(server, worker):
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER)
+    sys.modules["main"].start_warmup()
+
+
+def main():
+    # Imports main.py and thereby loads the model in the parent process
+    app = functions_framework.create_app(
+        target="get_radgraph",
+        source=str(pathlib.Path(__file__).parent / "main.py"),
+    )
+
+    # Moving all objects created so far into the permanent generation, so that garbage
+    # collections in the workers do not write to, and thereby copy, their memory pages
+    gc.freeze()
+
+    PreforkApplication(
+        app,
+        {
+            "bind": f"0.0.0.0:{PORT}",
+            "workers": WORKERS,
+            "threads": HTTP_THREADS_PER_WORKER,
+            "post_fork": post_fork,
+            "timeout": 0,
+        },
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,11 @@
 
 from radgraph import RadGraph
 
+from model_loading import get_serialized_model_path, save_model
+
 model = RadGraph(
     model_type="radgraph-xl",
     model_cache_dir="./",
     tokenizer_cache_dir="./",
 )
+save_model(model, get_serialized_model_path("radgraph-xl"))
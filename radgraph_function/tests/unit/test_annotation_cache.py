@@ -0,0 +1,81 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+from annotation_cache import AnnotationCache
+
+ANNOTATIONS = {"radgraph_text": "Lungs clear .", "processed_annotations": []}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = AnnotationCache("radgraph-xl/fp32", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Makes b the least recently used entry
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {
+        "memory_hits": 3,
+        "disk_hits": 0,
+        "misses": 1,
+        "entries": 2,
+    }
+
+
+def test_cache_ignores_whitespace():
+    cache = AnnotationCache("radgraph-xl/fp32", max_entries=2)
+    cache.put("Lungs  clear.\n", ANNOTATIONS)
+
+    assert cache.get(" Lungs clear.") == ANNOTATIONS
+
+
+def test_cache_without_memory_tier():
+    cache = AnnotationCache("radgraph-xl/fp32", max_entries=0)
+    cache.put("a", 1)
+
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_round_trips_through_disk(tmp_path):
+    AnnotationCache("radgraph-xl/fp32", max_entries=2, disk_dir=tmp_path).put(
+        "Lungs clear.", ANNOTATIONS
+    )
+    # A new cache, e.g. after a restart, only finds the entry on disk
+    cache = AnnotationCache("radgraph-xl/fp32", max_entries=2, disk_dir=tmp_path)
+
+    assert cache.get("Lungs clear.") == ANNOTATIONS
+    assert cache.get("Lungs clear.") == ANNOTATIONS
+    assert cache.stats() == {
+        "memory_hits": 1,
+        "disk_hits": 1,
+        "misses": 0,
+        "entries": 1,
+    }
+    assert [path.suffix for path in tmp_path.rglob("*") if path.is_file()] == [".json"]
+
+
+def test_cache_namespaces_disk_entries(tmp_path):
+    AnnotationCache("radgraph-xl/fp32", max_entries=2, disk_dir=tmp_path).put(
+        "Lungs clear.", ANNOTATIONS
+    )
+    cache = AnnotationCache("radgraph-xl/int8", max_entries=2, disk_dir=tmp_path)
+
+    assert cache.get("Lungs clear.") is None
+
+
+def test_cache_ignores_corrupt_disk_entries(tmp_path):
+    cache = AnnotationCache("radgraph-xl/fp32", max_entries=0, disk_dir=tmp_path)
+    cache.put("Lungs clear.", ANNOTATIONS)
+    (path,) = [path for path in tmp_path.rglob("*") if path.is_file()]
+    path.write_text('{"radgraph_text": ')
+
+    assert cache.get("Lungs clear.") is None
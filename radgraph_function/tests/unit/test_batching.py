@@ -0,0 +1,118 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import threading
+import time
+
+import pytest
+
+from batching import DeadlineExceededError, MicroBatcher, split_into_length_buckets
+
+
+def __record_batches(batches):
+    def run_batch(reports, is_batch_expired):
+        batches.append(reports)
+        return [report.upper() for report in reports]
+
+    return run_batch
+
+
+def test_micro_batcher_resolves_futures_of_one_batch():
+    batches = []
+    batcher = MicroBatcher(__record_batches(batches), max_batch_size=3, max_wait_sec=10)
+
+    futures = [batcher.submit(report) for report in ["a", "b", "c"]]
+
+    assert [future.result(timeout=5) for future in futures] == ["A", "B", "C"]
+    assert batches == [["a", "b", "c"]]
+    assert batcher.queue_depth() == 0
+
+
+def test_micro_batcher_flushes_after_max_wait():
+    batches = []
+    batcher = MicroBatcher(
+        __record_batches(batches), max_batch_size=8, max_wait_sec=0.05
+    )
+
+    start = time.monotonic()
+    assert batcher("a") == "A"
+
+    assert time.monotonic() - start >= 0.05
+    assert batches == [["a"]]
+
+
+def test_micro_batcher_splits_at_max_batch_size():
+    batches = []
+    batcher = MicroBatcher(
+        __record_batches(batches), max_batch_size=2, max_wait_sec=0.05
+    )
+
+    futures = [batcher.submit(report) for report in ["a", "b", "c"]]
+
+    assert [future.result(timeout=5) for future in futures] == ["A", "B", "C"]
+    assert batches == [["a", "b"], ["c"]]
+
+
+def test_micro_batcher_propagates_exception_to_all_futures():
+    error = RuntimeError("model failed")
+    started = threading.Event()
+
+    def run_batch(reports, is_batch_expired):
+        started.set()
+        raise error
+
+    batcher = MicroBatcher(run_batch, max_batch_size=2, max_wait_sec=0.05)
+
+    futures = [batcher.submit(report) for report in ["a", "b"]]
+
+    for future in futures:
+        with pytest.raises(RuntimeError) as raised:
+            future.result(timeout=5)
+        assert raised.value is error
+    assert started.is_set()
+
+    # The worker survives the failed batch
+    assert batcher.submit("c").exception(timeout=5) is error
+
+
+def test_micro_batcher_skips_expired_reports():
+    batches = []
+    batcher = MicroBatcher(__record_batches(batches), max_batch_size=2, max_wait_sec=10)
+
+    expired = batcher.submit("a", deadline=time.monotonic() - 1)
+    pending = batcher.submit("b", deadline=time.monotonic() + 60)
+
+    with pytest.raises(DeadlineExceededError):
+        expired.result(timeout=5)
+    assert pending.result(timeout=5) == "B"
+    assert batches == [["b"]]
+
+
+def test_length_buckets_keep_similar_reports_in_one_bucket():
+    assert split_into_length_buckets([5, 3, 4], 4096, 128) == [[1, 2, 0]]
+    assert split_into_length_buckets([], 4096, 128) == []
+
+
+def test_length_buckets_separate_long_reports():
+    assert split_into_length_buckets([1, 100, 1, 1], 4096, 10) == [[0, 2, 3], [1]]
+
+
+def test_length_buckets_of_equally_long_reports():
+    assert split_into_length_buckets([10] * 4, 4096, 1) == [[0, 1, 2, 3]]
+
+
+def test_length_buckets_respect_max_batch_tokens():
+    # A bucket may be exactly max_batch_tokens large
+    assert split_into_length_buckets([10] * 4, 40, 1) == [[0, 1, 2, 3]]
+    buckets = split_into_length_buckets([10] * 4, 39, 1)
+    assert len(buckets) == 2
+    assert all(len(bucket) * 10 <= 39 for bucket in buckets)
+    assert sorted(sum(buckets, [])) == [0, 1, 2, 3]
+    assert split_into_length_buckets([10] * 4, 20, 1) == [[0, 1], [2, 3]]
+    # A single report may exceed max_batch_tokens on its own
+    assert split_into_length_buckets([50, 60], 40, 1) == [[0], [1]]
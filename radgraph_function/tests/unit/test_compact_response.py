@@ -0,0 +1,126 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import gzip
+import json
+import pathlib
+import sys
+
+import flask
+
+from compact_response import (
+    COMPACT_MIMETYPE,
+    accepts_compact_response,
+    make_compact_response,
+    to_compact_response,
+)
+
+# The compact response is decoded by the Firebase functions, which are tested against it
+sys.path.insert(0, str(pathlib.Path(__file__).parents[3] / "firebase" / "functions"))
+from function_implementation.radgraph.radgraph_calling import (  # noqa: E402
+    __expand_compact_response,
+)
+
+app = flask.Flask(__name__)
+
+
+def __get_processed_annotations(report_count=1):
+    return {
+        "radgraph_text": "Left lung clear . " * report_count,
+        "radgraph_annotations": {
+            "0": {
+                "text": "Left lung clear . " * report_count,
+                "entities": {
+                    "1": {
+                        "tokens": "Left lung",
+                        "label": "Anatomy::definitely present",
+                        "start_ix": 0,
+                        "end_ix": 1,
+                        "relations": [],
+                    },
+                    "2": {
+                        "tokens": "clear",
+                        "label": "Observation::definitely present",
+                        "start_ix": 2,
+                        "end_ix": 2,
+                        "relations": [["located_at", "1"]],
+                    },
+                },
+                "data_source": None,
+            }
+        },
+        "processed_annotations": [
+            {
+                "observation": "clear",
+                "observation_start_ix": [2],
+                "observation_end_ix": [2],
+                "located_at": ["Left lung"],
+                "located_at_start_ix": [[0]],
+                "located_at_end_ix": [[1]],
+                "tags": ["definitely present"],
+                "suggestive_of": None,
+            }
+        ],
+        "radgraph_token_offsets": [[0, 4], [6, 10], [11, 16], None],
+    }
+
+
+def __decode(response):
+    data = response.get_data()
+    if response.headers.get("Content-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def test_compact_response_round_trips_through_client():
+    processed_annotations = __get_processed_annotations()
+    with app.test_request_context(headers={"Accept": COMPACT_MIMETYPE}):
+        assert accepts_compact_response(flask.request)
+        response = make_compact_response(flask.request, processed_annotations)
+
+    assert response.headers["Content-Type"] == COMPACT_MIMETYPE
+    assert "Content-Encoding" not in response.headers
+    assert __expand_compact_response(__decode(response)) == {
+        "radgraph_text": processed_annotations["radgraph_text"],
+        "processed_annotations": processed_annotations["processed_annotations"],
+        "radgraph_annotations": {
+            "0": {
+                "entities": {
+                    "1": {"start_ix": 0, "end_ix": 1},
+                    "2": {"start_ix": 2, "end_ix": 2},
+                }
+            }
+        },
+        "radgraph_token_offsets": [[0, 4], [6, 10], [11, 16], None],
+    }
+
+
+def test_compact_response_is_gzip_compressed_if_accepted():
+    processed_annotations = __get_processed_annotations(report_count=100)
+    with app.test_request_context(
+        headers={"Accept": COMPACT_MIMETYPE, "Accept-Encoding": "gzip"}
+    ):
+        response = make_compact_response(flask.request, processed_annotations)
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert __decode(response) == to_compact_response(processed_annotations)
+
+
+def test_compact_response_without_token_offsets():
+    processed_annotations = __get_processed_annotations()
+    del processed_annotations["radgraph_token_offsets"]
+
+    compact_response = to_compact_response(processed_annotations)
+
+    assert compact_response["entity_spans"] == [0, 1, 2, 2]
+    assert "radgraph_token_offsets" not in __expand_compact_response(compact_response)
+
+
+def test_full_response_is_not_compact_by_default():
+    with app.test_request_context(headers={"Accept": "application/json"}):
+        assert not accepts_compact_response(flask.request)
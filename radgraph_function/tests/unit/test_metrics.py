@@ -0,0 +1,54 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+from metrics import (
+    MetricsRegistry,
+    registry,
+    sentence_splitting_seconds,
+    token_counting_seconds,
+)
+
+
+def test_histogram_samples():
+    test_registry = MetricsRegistry()
+    histogram = test_registry.histogram(
+        "test_seconds", "Test histogram", [0.1, 1], {"route": "batch"}
+    )
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert test_registry.render().splitlines() == [
+        "# HELP test_seconds Test histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="batch",le="0.1"} 1',
+        'test_seconds_bucket{route="batch",le="1"} 2',
+        'test_seconds_bucket{route="batch",le="+Inf"} 3',
+        'test_seconds_sum{route="batch"} 5.55',
+        'test_seconds_count{route="batch"} 3',
+    ]
+
+
+def test_tokenization_stages_are_labeled():
+    token_counting_seconds.observe(0.001)
+    sentence_splitting_seconds.observe(0.001)
+    sentence_splitting_seconds.observe(0.001)
+
+    lines = registry.render().splitlines()
+
+    assert lines.count("# TYPE radgraph_tokenization_seconds histogram") == 1
+    counts = {
+        line.split(" ")[0]: line.split(" ")[1]
+        for line in lines
+        if line.startswith("radgraph_tokenization_seconds_count")
+    }
+    assert counts == {
+        'radgraph_tokenization_seconds_count{stage="token_counting"}': "1",
+        'radgraph_tokenization_seconds_count{stage="sentence_splitting"}': "2",
+        'radgraph_tokenization_seconds_count{stage="model_input"}': "0",
+    }
@@ -0,0 +1,118 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+from report_stitching import merge_annotations, pack_into_chunks, split_into_sentences
+
+
+def __entity(tokens, label, start_ix, end_ix, relations=None):
+    return {
+        "tokens": tokens,
+        "label": label,
+        "start_ix": start_ix,
+        "end_ix": end_ix,
+        "relations": relations or [],
+    }
+
+
+def test_split_into_sentences():
+    report = "FINDINGS:\nThe lungs are\nclear. No effusion!\n\nIMPRESSION: Normal."
+
+    assert split_into_sentences(report) == [
+        "FINDINGS:",
+        "The lungs are\nclear.",
+        "No effusion!",
+        "IMPRESSION: Normal.",
+    ]
+
+
+def test_pack_into_chunks():
+    sentences = ["FINDINGS:", "A.", "B.", "C.", "IMPRESSION:", "D."]
+
+    assert pack_into_chunks(sentences, [1, 2, 2, 2, 1, 2], 5) == [
+        "FINDINGS: A. B.",
+        "C.",
+        "IMPRESSION: D.",
+    ]
+
+
+def test_pack_into_chunks_keeps_long_sentences_on_their_own():
+    assert pack_into_chunks(["A.", "B.", "C."], [1, 10, 1], 5) == ["A.", "B.", "C."]
+    assert pack_into_chunks([], [], 5) == []
+
+
+def test_merge_annotations_rebases_token_indices_and_entity_ids():
+    annotations = [
+        {
+            "text": "Lungs are clear .",
+            "entities": {
+                "1": __entity("Lungs", "Anatomy::definitely present", 0, 0),
+                "2": __entity(
+                    "clear",
+                    "Observation::definitely present",
+                    2,
+                    2,
+                    [["located_at", "1"]],
+                ),
+            },
+            "data_source": None,
+        },
+        {"text": "No findings .", "entities": {}, "data_source": None},
+        {
+            "text": "Small left pleural effusion .",
+            "entities": {
+                "1": __entity(
+                    "pleural effusion",
+                    "Observation::definitely present",
+                    2,
+                    3,
+                    [["modify", "2"], ["located_at", "3"]],
+                ),
+                "2": __entity("Small", "Observation::definitely present", 0, 0),
+                "3": __entity("left", "Anatomy::definitely present", 1, 1),
+            },
+            "data_source": None,
+        },
+    ]
+
+    merged = merge_annotations(annotations)
+
+    assert merged["data_source"] is None
+    assert merged["text"] == (
+        "Lungs are clear . No findings . Small left pleural effusion ."
+    )
+    assert merged["entities"] == {
+        "1": __entity("Lungs", "Anatomy::definitely present", 0, 0),
+        "2": __entity(
+            "clear", "Observation::definitely present", 2, 2, [["located_at", "1"]]
+        ),
+        "3": __entity(
+            "pleural effusion",
+            "Observation::definitely present",
+            9,
+            10,
+            [["modify", "4"], ["located_at", "5"]],
+        ),
+        "4": __entity("Small", "Observation::definitely present", 7, 7),
+        "5": __entity("left", "Anatomy::definitely present", 8, 8),
+    }
+    # The rebased indices point at the tokens of the entities in the merged text
+    tokens = merged["text"].split(" ")
+    for entity in merged["entities"].values():
+        assert (
+            " ".join(tokens[entity["start_ix"] : entity["end_ix"] + 1])
+            == entity["tokens"]
+        )
+
+
+def test_merge_single_annotation_is_unchanged():
+    annotation = {
+        "text": "Lungs are clear .",
+        "entities": {"1": __entity("Lungs", "Anatomy::definitely present", 0, 0)},
+    }
+
+    assert merge_annotations([annotation]) == annotation
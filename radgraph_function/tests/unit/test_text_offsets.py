@@ -0,0 +1,100 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+import copy
+
+from text_offsets import add_text_offsets, get_token_offsets
+
+
+def test_token_offsets_of_repeated_tokens():
+    report = "no effusion, no no pneumothorax"
+    tokens = "no effusion , no no pneumothorax".split(" ")
+
+    assert get_token_offsets(report, tokens) == [
+        [0, 2],
+        [3, 11],
+        [11, 12],
+        [13, 15],
+        [16, 18],
+        [19, 31],
+    ]
+
+
+def test_token_offsets_of_whitespace_normalized_report():
+    report = "  Lungs\tclear.\n\nNo  effusion. "
+    tokens = "Lungs clear . No effusion .".split(" ")
+
+    offsets = get_token_offsets(report, tokens)
+
+    assert offsets == [[2, 7], [8, 13], [13, 14], [16, 18], [20, 28], [28, 29]]
+    assert [report[start:end] for start, end in offsets] == tokens
+
+
+def test_token_offsets_skip_rewritten_tokens():
+    report = "“Mild” effusion."
+    tokens = '" Mild " effusion .'.split(" ")
+
+    assert get_token_offsets(report, tokens) == [
+        None,
+        [1, 5],
+        None,
+        [7, 15],
+        [15, 16],
+    ]
+
+
+def test_token_offsets_do_not_skip_to_later_rewritten_token():
+    report = "“Mild” effusion." + " No change." * 30 + ' "Stable"'
+    tokens = ('" Mild " effusion .' + " No change ." * 30 + ' " Stable "').split(" ")
+
+    offsets = get_token_offsets(report, tokens)
+
+    assert offsets[:8] == [
+        None,
+        [1, 5],
+        None,
+        [7, 15],
+        [15, 16],
+        [17, 19],
+        [20, 26],
+        [26, 27],
+    ]
+    assert [report[start:end] for start, end in offsets[-3:]] == ['"', "Stable", '"']
+
+
+def test_add_text_offsets_does_not_modify_the_cached_annotations():
+    processed_annotations = {
+        "radgraph_text": "Left lung clear .",
+        "radgraph_annotations": {
+            "0": {
+                "entities": {
+                    "1": {"start_ix": 0, "end_ix": 1},
+                    "2": {"start_ix": 2, "end_ix": 2},
+                }
+            }
+        },
+        "processed_annotations": [
+            {
+                "observation_start_ix": [2],
+                "observation_end_ix": [2],
+                "located_at_start_ix": [[0]],
+            }
+        ],
+    }
+    cached_annotations = copy.deepcopy(processed_annotations)
+
+    with_offsets = add_text_offsets("Left  lung clear.", processed_annotations)
+
+    assert processed_annotations == cached_annotations
+    assert with_offsets["processed_annotations"][0]["located_at_end_ix"] == [[1]]
+    assert with_offsets["radgraph_token_offsets"] == [
+        [0, 4],
+        [6, 10],
+        [11, 16],
+        [16, 17],
+    ]
@@ -0,0 +1,70 @@
+#
+# This source file is part of the Stanford Biodesign Digital Health RadGPT open-source project
+#
+# SPDX-FileCopyrightText: 2024 Stanford University and the project authors (see CONTRIBUTORS.md)
+#
+# SPDX-License-Identifier: MIT
+#
+
+from typing import Any, Dict, List, Optional
+
+
+# Maximum number of characters between two tokens in the report that are searched for
+# a token that does not directly follow the previous one, as in the text mapping of the
+# Firebase functions
+MAX_TOKEN_GAP = 256
+
+
+# Character range [start, end) of every token of the radgraph_text in the report. The
+# RadGraph tokenizer only inserts whitespace between the characters of the report, so
+# every token is first compared at the next non-whitespace character and otherwise
+# searched within the next MAX_TOKEN_GAP characters. Tokens the tokenizer rewrote, e.g.
+# quotes, are not found and have no range, without moving the following tokens to a
+# later occurrence of the rewritten token.
+def get_token_offsets(report: str, tokens: List[str]) -> List[Optional[List[int]]]:
+    token_offsets = []
+    text_pointer = 0
+    for token in tokens:
+        while text_pointer < len(report) and report[text_pointer].isspace():
+            text_pointer += 1
+
+        if report.startswith(token, text_pointer):
+            start = text_pointer
+        else:
+            start = report.find(
+                token, text_pointer, text_pointer + MAX_TOKEN_GAP + len(token)
+            )
+            if start == -1:
+                token_offsets.append(None)
+                continue
+        text_pointer = start + len(token)
+        token_offsets.append([start, text_pointer])
+    return token_offsets
+
+
+# Adds the token offsets into the report and the located_at_end_ix that
+# get_radgraph_processed_annotations leaves out, so that the caller can map the entities
+# to the report without aligning the tokens itself. Does not modify the given processed
+# annotations, as they are shared with the cache.
+def add_text_offsets(report: str, processed_annotations: Dict[str, Any]):
+    processed_annotations = dict(processed_annotations)
+    entities = processed_annotations["radgraph_annotations"]["0"]["entities"]
+    # The first entity with a start index wins, like in the mapping of the caller
+    end_ix_by_start_ix = {}
+    for entity in entities.values():
+        end_ix_by_start_ix.setdefault(entity["start_ix"], entity["end_ix"])
+
+    annotations_with_end_ix = []
+    for processed_annotation in processed_annotations["processed_annotations"]:
+        processed_annotation = dict(processed_annotation)
+        processed_annotation["located_at_end_ix"] = [
+            [end_ix_by_start_ix.get(start_ix) for start_ix in located_at_start_ix]
+            for located_at_start_ix in processed_annotation["located_at_start_ix"]
+        ]
+        annotations_with_end_ix.append(processed_annotation)
+    processed_annotations["processed_annotations"] = annotations_with_end_ix
+
+    processed_annotations["radgraph_token_offsets"] = get_token_offsets(
+        report, processed_annotations["radgraph_text"].split(" ")
+    )
+    return processed_annotations